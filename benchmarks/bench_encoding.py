@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_check import ParserServerRequest, ResponseEncoder, iter_response  # noqa: E402
+
+RESULT = {
+    'username': 'usuario01',
+    'count_connection': 2,
+    'limit_connection': 3,
+    'expiration_date': '31/12/2026',
+    'expiration_days': 75,
+    'time_online': '01:23:45',
+    'version': '2.1.4',
+}
+
+
+def build_request(accept: str, users: int = 0) -> ParserServerRequest:
+    target = '/check/usuario01'
+    if users:
+        target = '/check?users=%s' % ','.join('usuario%02d' % index for index in range(users))
+
+    request = ParserServerRequest()
+    request.parse_head(
+        ('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: %s' % (target, accept)).encode()
+    )
+    return request
+
+
+def bench_response(request: ParserServerRequest, users: int) -> int:
+    if users:
+        results = iter([RESULT] * users)
+    else:
+        results = RESULT
+
+    return sum(len(frame) for frame in iter_response(request, results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check result encoding microbenchmark')
+    parser.add_argument('-n', '--number', type=int, default=100000, help='Iterations per case')
+    parser.add_argument('--users', type=int, default=50, help='Users per batch response')
+    args = parser.parse_args()
+
+    encoder = ResponseEncoder.get_instance()
+
+    print('%-45s %10s %10s' % ('single result', 'us', 'bytes'))
+
+    cases = [
+        ('json.dumps', lambda: json.dumps(RESULT).encode('utf-8')),
+        ('ResponseEncoder json', lambda: encoder.encode(RESULT, encoder.JSON)),
+        ('ResponseEncoder msgpack', lambda: encoder.encode(RESULT, encoder.MSGPACK)),
+        ('ResponseEncoder msgpack (built-in)', lambda: encoder.pack(RESULT)),
+        ('ResponseEncoder struct', lambda: encoder.encode(RESULT, encoder.STRUCT)),
+    ]
+
+    for name, function in cases:
+        elapsed = min(timeit.repeat(function, number=args.number, repeat=3))
+        print('%-45s %10.2f %10d' % (name, elapsed / args.number * 1e6, len(function())))
+
+    print()
+    print('%-45s %10s %10s' % ('full HTTP response', 'us', 'bytes'))
+
+    number = max(args.number // args.users, 1)
+
+    for accept in (encoder.JSON, encoder.MSGPACK, encoder.STRUCT):
+        for users in (0, args.users):
+            request = build_request(accept, users)
+            name = '%s %s' % (accept, 'x%d users' % users if users else 'single')
+
+            elapsed = min(
+                timeit.repeat(lambda: bench_response(request, users), number=number, repeat=3)
+            )
+            size = bench_response(request, users)
+            print('%-45s %10.2f %10d' % (name, elapsed / number * 1e6, size))
+
+
+if __name__ == '__main__':
+    main()
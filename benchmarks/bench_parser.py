@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_check import ParserServerRequest, RequestStreamParser  # noqa: E402
+
+REQUEST = (
+    b'GET /check/usuario01 HTTP/1.1\r\n'
+    b'Host: 127.0.0.1:5000\r\n'
+    b'User-Agent: okhttp/4.9.0\r\n'
+    b'Accept: application/json\r\n'
+    b'Connection: keep-alive\r\n\r\n'
+)
+
+
+class LegacyParserServerRequest:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.command = None
+        self.content = None
+
+    def parse(self) -> None:
+        try:
+            data = self.data.decode('utf-8')
+
+            first_line = data.split('\n')[0]
+            path = first_line.split(' ')[1]
+
+            self.command = path.split('/')[1]
+            self.content = path.split('/')[2].split('?')[0]
+
+        except Exception:
+            self.command = None
+            self.content = None
+
+
+def bench_legacy() -> None:
+    request = LegacyParserServerRequest(REQUEST.strip())
+    request.parse()
+
+
+def bench_parser() -> None:
+    request = ParserServerRequest(REQUEST)
+    request.parse()
+
+
+def bench_stream() -> None:
+    RequestStreamParser().feed(REQUEST)
+
+
+def bench_stream_fragmented(fragments: int) -> None:
+    size = len(REQUEST) // fragments + 1
+    parser = RequestStreamParser()
+
+    for offset in range(0, len(REQUEST), size):
+        parser.feed(REQUEST[offset : offset + size])
+
+
+def bench_stream_pipelined(requests: int) -> None:
+    RequestStreamParser().feed(REQUEST * requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Request parser microbenchmark')
+    parser.add_argument('-n', '--number', type=int, default=100000, help='Iterations per case')
+    parser.add_argument('--fragments', type=int, default=8, help='Fragments per request')
+    parser.add_argument('--pipelined', type=int, default=10, help='Requests per pipelined read')
+    args = parser.parse_args()
+
+    cases = [
+        ('legacy ParserServerRequest', bench_legacy, 1),
+        ('ParserServerRequest.parse', bench_parser, 1),
+        ('RequestStreamParser.feed', bench_stream, 1),
+        (
+            'RequestStreamParser.feed x%d fragments' % args.fragments,
+            lambda: bench_stream_fragmented(args.fragments),
+            1,
+        ),
+        (
+            'RequestStreamParser.feed %d pipelined' % args.pipelined,
+            lambda: bench_stream_pipelined(args.pipelined),
+            args.pipelined,
+        ),
+    ]
+
+    for name, function, requests in cases:
+        elapsed = min(timeit.repeat(function, number=args.number, repeat=3))
+        print('%-45s %8.2f us/request' % (name, elapsed / args.number / requests * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+import typing as t
+
+import os
+import sys
+import ssl
+import time
+import socket
+import argparse
+import selectors
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROXY = os.path.join(ROOT, 'scripts', 'proxy.py')
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def listen() -> socket.socket:
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    return sock
+
+
+class SourceServer(threading.Thread):
+    CHUNK = b'x' * 262144
+
+    def __init__(self, size: int):
+        super().__init__(daemon=True)
+        self.size = size
+        self.sock = listen()
+        self.port = self.sock.getsockname()[1]
+
+    def send(self, conn: socket.socket) -> None:
+        left = self.size
+        view = memoryview(self.CHUNK)
+
+        try:
+            while left > 0:
+                left -= conn.send(view[: min(left, len(view))])
+        finally:
+            conn.close()
+
+    def run(self) -> None:
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self.send, args=(conn,), daemon=True).start()
+
+
+class EchoServer(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.sock = listen()
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.selector = selectors.DefaultSelector()
+
+    def run(self) -> None:
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.sock:
+                    conn, _ = self.sock.accept()
+                    conn.setblocking(False)
+                    self.selector.register(conn, selectors.EVENT_READ)
+                    continue
+
+                try:
+                    data = key.fileobj.recv(65536)
+                    if data:
+                        key.fileobj.sendall(data)
+                        continue
+                except OSError:
+                    pass
+
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
+
+
+class ProxyProcess:
+    def __init__(self, engine: str, cert: str = None, extra: list = None, resume: bool = False):
+        self.port = get_free_port()
+        self.cert = cert
+        self.resume = resume
+        self.session = None
+        self.resumed = 0
+
+        command = [sys.executable, PROXY, '--engine', engine, '--port', str(self.port)]
+        command += ['--https', '--cert', cert] if cert else ['--http']
+        command += ['--log', 'CRITICAL', '--backlog', '4096'] + (extra or [])
+
+        self.process = subprocess.Popen(command)
+        self.context = None
+
+        if cert:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+
+        raise RuntimeError('Proxy did not start')
+
+    def pids(self) -> t.List[int]:
+        path = '/proc/%d/task/%d/children' % (self.process.pid, self.process.pid)
+        with open(path) as f:
+            return [self.process.pid] + [int(pid) for pid in f.read().split()]
+
+    def stat(self) -> dict:
+        total = {'cpu': 0.0, 'rss_mb': 0.0, 'threads': 0}
+
+        # With --workers the supervisor forks the processes that do the work
+        for pid in self.pids():
+            with open('/proc/%d/stat' % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+
+            with open('/proc/%d/status' % pid) as f:
+                status = dict(line.split(':', 1) for line in f)
+
+            total['cpu'] += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+            total['rss_mb'] += int(status['VmRSS'].split()[0]) / 1024
+            total['threads'] += int(status['Threads'])
+
+        return total
+
+    def open_tunnel(self, port: int) -> t.Tuple[socket.socket, bytes]:
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        if self.context is not None:
+            sock = self.context.wrap_socket(sock, session=self.session)
+
+        sock.sendall(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n' % port)
+
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError('Proxy closed the tunnel')
+            response += data
+
+        # TLS 1.3 tickets arrive after the handshake, so the session is taken once data has flowed
+        if self.context is not None and self.resume:
+            self.resumed += sock.session_reused
+            self.session = sock.session
+
+        # Tunnelled bytes may arrive in the same read as the handshake response
+        return sock, response.partition(b'\r\n\r\n')[2]
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+
+def bench_throughput(proxy: ProxyProcess, source: SourceServer) -> dict:
+    sock, data = proxy.open_tunnel(source.port)
+    before = proxy.stat()
+    start = time.perf_counter()
+
+    received = len(data)
+    while received < source.size:
+        data = sock.recv(1048576)
+        if not data:
+            break
+        received += len(data)
+
+    elapsed = time.perf_counter() - start
+    cpu = proxy.stat()['cpu'] - before['cpu']
+    sock.close()
+
+    return {
+        'mb_s': received / elapsed / 1e6,
+        'cpu_s_gb': cpu / (received / 1e9),
+    }
+
+
+def bench_tunnels(proxy: ProxyProcess, echo: EchoServer, tunnels: int, duration: float) -> dict:
+    socks = []
+    before = proxy.stat()
+    start = time.perf_counter()
+
+    # The thread engine's select() cannot watch descriptors above FD_SETSIZE, so stop at the limit
+    try:
+        for _ in range(tunnels):
+            socks.append(proxy.open_tunnel(echo.port)[0])
+    except OSError:
+        pass
+
+    setup = time.perf_counter() - start
+    setup_cpu = proxy.stat()['cpu'] - before['cpu']
+
+    message = b'm' * 64
+    selector = selectors.DefaultSelector()
+    sent_at = {}
+
+    for sock in socks:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, bytearray())
+        sock.send(message)
+        sent_at[sock] = time.perf_counter()
+
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    while time.perf_counter() < deadline:
+        for key, _ in selector.select(0.5):
+            try:
+                data = key.fileobj.recv(65536)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                continue
+
+            key.data.extend(data)
+            if len(key.data) < len(message):
+                continue
+
+            now = time.perf_counter()
+            latencies.append(now - sent_at[key.fileobj])
+            key.data.clear()
+
+            key.fileobj.send(message)
+            sent_at[key.fileobj] = now
+
+    stat = proxy.stat()
+
+    for sock in socks:
+        sock.close()
+
+    latencies.sort()
+
+    return {
+        'open': len(socks),
+        'resumed': proxy.resumed,
+        'setup_s': len(socks) / setup,
+        'setup_cpu_ms': setup_cpu / len(socks) * 1000 if socks else 0,
+        'rtt_s': len(latencies) / duration,
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+        'rss_mb': stat['rss_mb'],
+        'threads': stat['threads'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Proxy engine benchmark')
+    parser.add_argument('--engines', default='threads,epoll', help='Comma separated engines')
+    parser.add_argument('--relays', default='buffered', help='Comma separated relay modes')
+    parser.add_argument('--megabytes', type=int, default=1024, help='Bulk download size')
+    parser.add_argument('--tunnels', type=int, default=500, help='Concurrent echo tunnels')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds of echo traffic')
+    parser.add_argument('--cert', type=str, help='Benchmark HTTPS mode with this certificate')
+    parser.add_argument('--workers', type=int, default=1, help='Proxy worker processes')
+    parser.add_argument(
+        '--resume', action='store_true', help='Reuse the previous TLS session for each tunnel'
+    )
+    args = parser.parse_args()
+
+    source = SourceServer(args.megabytes * 1024 * 1024)
+    source.start()
+
+    echo = EchoServer()
+    echo.start()
+
+    columns = ('engine', 'relay', 'MB/s', 'cpu s/GB', 'tunnels', 'resumed', 'tunnels/s')
+    print(
+        '%-8s %-9s %8s %9s %8s %8s %10s %10s %9s %8s %8s %7s %7s'
+        % (columns + ('cpu ms/tun', 'rtt/s', 'p50 ms', 'p99 ms', 'rss MB', 'threads'))
+    )
+
+    for engine in args.engines.split(','):
+        for relay in args.relays.split(','):
+            extra = ['--relay', relay, '--workers', str(args.workers)]
+            proxy = ProxyProcess(engine, args.cert, extra, args.resume)
+
+            try:
+                throughput = bench_throughput(proxy, source)
+                tunnels = bench_tunnels(proxy, echo, args.tunnels, args.duration)
+            finally:
+                proxy.stop()
+
+            print(
+                '%-8s %-9s %8.0f %9.2f %8d %8d %10.0f %10.2f %9.0f %8.2f %8.2f %7.1f %7d'
+                % (
+                    engine,
+                    relay,
+                    throughput['mb_s'],
+                    throughput['cpu_s_gb'],
+                    tunnels['open'],
+                    tunnels['resumed'],
+                    tunnels['setup_s'],
+                    tunnels['setup_cpu_ms'],
+                    tunnels['rtt_s'],
+                    tunnels['p50_ms'],
+                    tunnels['p99_ms'],
+                    tunnels['rss_mb'],
+                    tunnels['threads'],
+                )
+            )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'user_check.py')
+
+LAUNCHER = 'import sys; sys.path.insert(0, %r); from user_check import main; main()' % ROOT
+
+
+def parse_importtime(output: str):
+    modules = []
+
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:') :].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    return modules
+
+
+def measure_importtime():
+    command = [sys.executable, '-X', 'importtime', '-c', 'import user_check']
+
+    # Compile up front, like an installed module, so source compilation is not counted
+    subprocess.run([sys.executable, '-m', 'py_compile', SCRIPT], check=True)
+    process = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+
+    return parse_importtime(process.stderr)
+
+
+def measure_wall(command, runs: int) -> float:
+    best = float('inf')
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time and import budget for checker -u')
+    parser.add_argument('-u', '--username', type=str, default='root', help='User to check')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='Runs per command')
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports to list')
+    parser.add_argument(
+        '--budget-ms',
+        type=float,
+        default=60.0,
+        help='Fail when importing user_check takes longer than this',
+    )
+    args = parser.parse_args()
+
+    modules = measure_importtime()
+    total = next(cumulative for name, _, cumulative in modules if name == 'user_check')
+
+    print('Slowest imports (cumulative):')
+    for name, self_us, cumulative_us in sorted(modules, key=lambda m: -m[2])[1 : args.top + 1]:
+        print('  %-40s %8.2f ms (self %.2f ms)' % (name, cumulative_us / 1000, self_us / 1000))
+
+    print()
+    print('%-45s %8.2f ms' % ('import user_check', total / 1000))
+
+    cases = [
+        ('python -c pass', [sys.executable, '-c', 'pass']),
+        (
+            'user_check.py -u %s (script)' % args.username,
+            [sys.executable, SCRIPT, '-u', args.username],
+        ),
+        (
+            'checker -u %s (launcher)' % args.username,
+            [sys.executable, '-c', LAUNCHER, '-u', args.username],
+        ),
+    ]
+
+    for name, command in cases:
+        print('%-45s %8.2f ms' % (name, measure_wall(command, args.runs) * 1000))
+
+    if total / 1000 > args.budget_ms:
+        print()
+        print('Import budget exceeded: %.2f ms > %.2f ms' % (total / 1000, args.budget_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
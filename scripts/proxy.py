@@ -1,13 +1,24 @@
 import socket
 import ssl
 import select
+import selectors
 import threading
+import queue
+import errno
+import fcntl
+import signal
+import time
 import os
+import multiprocessing
 import argparse
 import logging
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 from urllib.parse import urlparse
-from typing import List, Tuple, Union, Optional
+from typing import Callable, Dict, List, Tuple, Union, Optional
 
 __author__ = 'Glemison C. Dutra'
 __version__ = '1.0.1'
@@ -31,6 +42,12 @@ usage = f'''
         
     # Finalizar uso em background:
         screen -X -S proxy quit
+
+    # Vários processos na mesma porta:
+        python3 proxy.py --http --port 80 --workers 4 --engine epoll
+
+        Reiniciar os workers sem derrubar conexões: kill -HUP <pid>
+        Estatísticas de conexões no log: kill -USR1 <pid>
 '''
 
 logger = logging.getLogger(__name__)
@@ -38,6 +55,11 @@ logger = logging.getLogger(__name__)
 DEFAULT_RESPONSE = b'HTTP/1.1 101 Connection Established\r\n\r\n'
 REMOTE_ADDRESS = ('0.0.0.0', 22)
 
+RELAY_MODE = 'buffered'
+SPLICE_SUPPORTED = hasattr(os, 'splice') and hasattr(fcntl, 'F_SETPIPE_SZ')
+
+STATS = None
+
 
 class HttpParser:
     def __init__(self) -> None:
@@ -69,12 +91,77 @@ class HttpParser:
         return base.encode('utf-8') + headers.encode('utf-8') + self.body.encode('utf-8')
 
 
+class Pipe:
+    # Bytes moved with splice() go socket -> pipe -> socket without being copied into Python
+    def __init__(self, size: int) -> None:
+        self.__read_fd, self.__write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        try:
+            fcntl.fcntl(self.__write_fd, fcntl.F_SETPIPE_SZ, size)
+        except OSError:
+            pass
+
+        self.size = fcntl.fcntl(self.__write_fd, fcntl.F_GETPIPE_SZ)
+        self.pending = 0
+        self.full = False
+        self.flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+    def fill(self, sock: socket.socket) -> Optional[int]:
+        space = self.size - self.pending
+
+        # splice() of 0 bytes returns 0, which would read as EOF
+        if space <= 0:
+            self.full = True
+            return 0
+
+        try:
+            moved = os.splice(sock.fileno(), self.__write_fd, space, flags=self.flags)
+        except BlockingIOError:
+            # Every splice takes a pipe slot, so small segments can fill it long before size bytes
+            if not self.pending:
+                raise
+
+            self.full = True
+            return 0
+
+        if moved == 0:
+            return None
+
+        self.pending += moved
+        return moved
+
+    def drain(self, sock: socket.socket) -> int:
+        moved = os.splice(self.__read_fd, sock.fileno(), self.pending, flags=self.flags)
+        self.pending -= moved
+
+        if not self.pending:
+            self.full = False
+
+        return moved
+
+    def close(self) -> None:
+        os.close(self.__read_fd)
+        os.close(self.__write_fd)
+
+
 class Connection:
+    READ_SIZE = 65536
+
+    # Reading from the peer stops above HIGH_WATERMARK pending bytes and resumes below LOW_WATERMARK
+    HIGH_WATERMARK = 1024 * 1024
+    LOW_WATERMARK = 256 * 1024
+
+    MAX_IOV = 64
+
     def __init__(self, conn: Union[socket.socket, ssl.SSLSocket], addr: Tuple[str, int]):
         self.__conn = conn
         self.__addr = addr
-        self.__buffer = b''
+        self.__chunks = deque()
+        self.__offset = 0
+        self.__pending = 0
+        self.__congested = False
         self.__closed = False
+        self.__pipe = None
 
     @property
     def conn(self) -> Union[socket.socket, ssl.SSLSocket]:
@@ -106,11 +193,24 @@ class Connection:
 
     @property
     def buffer(self) -> bytes:
-        return self.__buffer
+        return b''.join(self.__chunks)[self.__offset :]
 
     @buffer.setter
     def buffer(self, data: bytes) -> None:
-        self.__buffer = data
+        self.__chunks.clear()
+        self.__offset = 0
+        self.__pending = 0
+
+        if data:
+            self.queue(data)
+
+    @property
+    def pending(self) -> int:
+        return self.__pending + (self.__pipe.pending if self.__pipe is not None else 0)
+
+    @property
+    def congested(self) -> bool:
+        return self.__congested
 
     @property
     def closed(self) -> bool:
@@ -124,8 +224,35 @@ class Connection:
         self.conn.close()
         self.closed = True
 
-    def read(self, size: int = 4096) -> Optional[bytes]:
-        data = self.conn.recv(size)
+        if self.__pipe is not None:
+            self.__pipe.close()
+            self.__pipe = None
+
+    def enable_splice(self) -> bool:
+        if not SPLICE_SUPPORTED or isinstance(self.conn, ssl.SSLSocket):
+            return False
+
+        if self.__pipe is None:
+            self.__pipe = Pipe(self.HIGH_WATERMARK)
+
+        return True
+
+    def receive_from(self, source: 'Connection') -> Optional[int]:
+        if self.__pipe is not None and not isinstance(source.conn, ssl.SSLSocket):
+            moved = self.__pipe.fill(source.conn)
+
+            if self.__pipe.full or (
+                moved is not None and self.pending >= min(self.HIGH_WATERMARK, self.__pipe.size)
+            ):
+                self.__congested = True
+
+            return moved
+
+        data = source.read()
+        return self.queue(data) if data is not None else None
+
+    def read(self, size: int = None) -> Optional[bytes]:
+        data = self.conn.recv(size or self.READ_SIZE)
         return data if len(data) > 0 else None
 
     def write(self, data: Union[bytes, str]) -> int:
@@ -144,12 +271,47 @@ class Connection:
         if len(data) <= 0:
             raise ValueError('Queue data is empty')
 
-        self.__buffer += data
+        self.__chunks.append(data)
+        self.__pending += len(data)
+
+        if self.__pending >= self.HIGH_WATERMARK:
+            self.__congested = True
+
         return len(data)
 
     def flush(self) -> int:
-        sent = self.write(self.__buffer)
-        self.__buffer = self.__buffer[sent:]
+        # Bytes queued before splicing started are older than the ones in the pipe
+        if not self.__chunks:
+            if self.__pipe is None or not self.__pipe.pending:
+                return 0
+
+            sent = self.__pipe.drain(self.conn)
+
+            if self.pending <= self.LOW_WATERMARK and not self.__pipe.full:
+                self.__congested = False
+
+            return sent
+
+        first = memoryview(self.__chunks[0])[self.__offset :]
+
+        # SSL sockets cannot gather, so they send one chunk at a time
+        if isinstance(self.conn, ssl.SSLSocket):
+            sent = self.conn.send(first)
+        else:
+            sent = self.conn.sendmsg([first, *islice(self.__chunks, 1, self.MAX_IOV)])
+
+        self.__pending -= sent
+        sent_left = sent + self.__offset
+
+        while self.__chunks and sent_left >= len(self.__chunks[0]):
+            sent_left -= len(self.__chunks.popleft())
+
+        self.__offset = sent_left
+
+        pipe_full = self.__pipe is not None and self.__pipe.full
+        if self.pending <= self.LOW_WATERMARK and not pipe_full:
+            self.__congested = False
+
         return sent
 
 
@@ -174,32 +336,60 @@ class Server(Connection):
         logger.info(f'{self} Conexão estabelecida')
 
 
-class Proxy(threading.Thread):
-    def __init__(self, client: Client, server: Optional[Server] = None) -> None:
-        super().__init__()
+class Stats:
+    FIELDS = ('total', 'active', 'errors')
+    TOTAL, ACTIVE, ERRORS = range(len(FIELDS))
 
-        self.client = client
-        self.server = server
+    # Each worker only writes its own slot, so the shared memory needs no cross-process lock
+    def __init__(self, slots: int = 1) -> None:
+        self.__values = multiprocessing.RawArray('q', slots * len(self.FIELDS))
+        self.__lock = threading.Lock()
+        self.slots = slots
+        self.slot = 0
 
-        self.http_parser = HttpParser()
+    def __add(self, field: int, value: int) -> None:
+        with self.__lock:
+            self.__values[self.slot * len(self.FIELDS) + field] += value
 
-        self.__running = False
+    def opened(self) -> None:
+        self.__add(self.TOTAL, 1)
+        self.__add(self.ACTIVE, 1)
+
+    def closed(self, error: bool = False) -> None:
+        self.__add(self.ACTIVE, -1)
+        if error:
+            self.__add(self.ERRORS, 1)
 
     @property
-    def running(self) -> bool:
-        if self.server and self.server.closed and self.client.closed:
-            self.__running = False
-        return self.__running
+    def active(self) -> int:
+        return self.__values[self.slot * len(self.FIELDS) + self.ACTIVE]
 
-    @running.setter
-    def running(self, value: bool) -> None:
-        self.__running = value
+    def reset(self, slot: int) -> None:
+        # A worker that died or was killed no longer holds its connections
+        self.__values[slot * len(self.FIELDS) + self.ACTIVE] = 0
 
-    def _process_request(self, data: bytes) -> None:
-        if self.server and not self.server.closed:
-            self.server.queue(data)
-            return
+    def summary(self) -> Dict[str, int]:
+        return {
+            name: sum(self.__values[index :: len(self.FIELDS)])
+            for index, name in enumerate(self.FIELDS)
+        }
+
+
+class ProxyHandler:
+    def __init__(self, client: Client, server: Optional[Server] = None) -> None:
+        self.client = client
+        self.server = server
+
+        self.http_parser = HttpParser()
+
+        if STATS is not None:
+            STATS.opened()
 
+    def _count_closed(self, error: Optional[Exception] = None) -> None:
+        if STATS is not None:
+            STATS.closed(error is not None)
+
+    def _parse_target(self, data: bytes) -> Tuple[str, int]:
         self.http_parser.parse(data)
 
         if self.http_parser.method == 'CONNECT':
@@ -214,9 +404,9 @@ class Proxy(threading.Thread):
         else:
             raise ValueError('Invalid URL')
 
-        self.server = Server.of((host, int(port)))
-        self.server.connect()
+        return host, int(port)
 
+    def _on_connected(self, port: int) -> None:
         if (
             self.http_parser.method == 'CONNECT'
             or str(port) == '22'
@@ -227,18 +417,56 @@ class Proxy(threading.Thread):
         else:
             self.server.queue(self.http_parser.build())
 
+        if RELAY_MODE == 'splice':
+            self.client.enable_splice()
+            self.server.enable_splice()
+
         logger.info(f'{self.client} -> Solicitação: {self.http_parser.build()}')
 
+    def _process_request(self, data: bytes) -> None:
+        if self.server and not self.server.closed:
+            self.server.queue(data)
+            return
+
+        host, port = self._parse_target(data)
+
+        self.server = Server.of((host, port))
+        self.server.connect()
+
+        self._on_connected(port)
+
+
+class Proxy(ProxyHandler, threading.Thread):
+    def __init__(self, client: Client, server: Optional[Server] = None) -> None:
+        ProxyHandler.__init__(self, client, server)
+        threading.Thread.__init__(self)
+
+        self.__running = False
+
+    @property
+    def running(self) -> bool:
+        if self.server and self.server.closed and self.client.closed:
+            self.__running = False
+        return self.__running
+
+    @running.setter
+    def running(self, value: bool) -> None:
+        self.__running = value
+
     def _get_waitable_lists(self) -> Tuple[List[socket.socket]]:
-        r, w, e = [self.client.conn], [], []
+        r, w, e = [], [], []
 
-        if self.server and not self.server.closed:
+        # A peer is only read while the other side is keeping up with what it already has queued
+        if not (self.server and not self.server.closed and self.server.congested):
+            r.append(self.client.conn)
+
+        if self.server and not self.server.closed and not self.client.congested:
             r.append(self.server.conn)
 
-        if self.client.buffer:
+        if self.client.pending:
             w.append(self.client.conn)
 
-        if self.server and not self.server.closed and self.server.buffer:
+        if self.server and not self.server.closed and self.server.pending:
             w.append(self.server.conn)
 
         return r, w, e
@@ -254,18 +482,21 @@ class Proxy(threading.Thread):
 
     def _process_rlist(self, rlist: List[socket.socket]) -> None:
         if self.client.conn in rlist:
-            data = self.client.read()
-            self.running = data is not None
-            if data and self.running:
-                self._process_request(data)
-                logger.debug(f'{self.client} recebeu {len(data)} Bytes')
+            if self.server and not self.server.closed:
+                received = self.server.receive_from(self.client)
+                self.running = received is not None
+                logger.debug(f'{self.client} recebeu {received} Bytes')
+            else:
+                data = self.client.read()
+                self.running = data is not None
+                if data and self.running:
+                    self._process_request(data)
+                    logger.debug(f'{self.client} recebeu {len(data)} Bytes')
 
         if self.server and not self.server.closed and self.server.conn in rlist:
-            data = self.server.read()
-            self.running = data is not None
-            if data and self.running:
-                self.client.queue(data)
-                logger.debug(f'{self.server} recebeu {len(data)} Bytes')
+            received = self.client.receive_from(self.server)
+            self.running = received is not None
+            logger.debug(f'{self.server} recebeu {received} Bytes')
 
     def _process(self) -> None:
         self.running = True
@@ -277,89 +508,713 @@ class Proxy(threading.Thread):
             self._process_wlist(w)
             self._process_rlist(r)
 
+    def _handshake(self) -> None:
+        conn = self.client.conn
+        if not isinstance(conn, ssl.SSLSocket):
+            return
+
+        # HTTPS hands over the socket before the TLS handshake, which runs on this thread
+        conn.settimeout(Handshake.TIMEOUT)
+        conn.do_handshake()
+        conn.settimeout(None)
+
     def run(self) -> None:
+        error = None
+
         try:
             logger.info(f'{self.client} Conectado')
+            self._handshake()
             self._process()
         except Exception as e:
+            error = e
             logger.error(f'{self.client} Erro: {e}')
         finally:
             self.client.close()
             if self.server and not self.server.closed:
                 self.server.close()
+            self._count_closed(error)
             logger.info(f'{self.client} Desconectado')
 
 
+class EventLoop:
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.connecting = set()
+        self.running = False
+
+        self.__callbacks = queue.Queue()
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.register(self.__wakeup_reader, selectors.EVENT_READ, self.__run_callbacks)
+
+    def register(self, sock: socket.socket, events: int, callback: Callable[[int], None]) -> None:
+        self.selector.register(sock, events, callback)
+
+    def set_events(self, sock: socket.socket, events: int, callback: Callable[[int], None]) -> None:
+        try:
+            key = self.selector.get_key(sock)
+        except KeyError:
+            key = None
+
+        if not events:
+            if key is not None:
+                self.selector.unregister(sock)
+        elif key is None:
+            self.selector.register(sock, events, callback)
+        elif key.events != events:
+            self.selector.modify(sock, events, callback)
+
+    def unregister(self, sock: socket.socket) -> None:
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def call_soon_threadsafe(self, callback: Callable[[], None]) -> None:
+        self.__callbacks.put(callback)
+        self.__wakeup_writer.send(b'\0')
+
+    def __run_callbacks(self, mask: int) -> None:
+        try:
+            self.__wakeup_reader.recv(4096)
+        except BlockingIOError:
+            pass
+
+        while not self.__callbacks.empty():
+            self.__callbacks.get()()
+
+    def run_once(self, timeout: float = 1) -> None:
+        for key, mask in self.selector.select(timeout):
+            key.data(mask)
+
+        now = time.monotonic()
+        for tunnel in list(self.connecting):
+            tunnel.check_timeout(now)
+
+    def stop(self) -> None:
+        self.running = False
+
+    def run(self) -> None:
+        self.running = True
+
+        while self.running:
+            self.run_once()
+
+
+class Tunnel(ProxyHandler):
+    CONNECT_TIMEOUT = 5
+    RESOLVER_WORKERS = 4
+
+    resolver = None
+
+    def __init__(self, loop: EventLoop, client: Client) -> None:
+        super().__init__(client)
+
+        self.loop = loop
+        self.port = None
+        self.connect_deadline = None
+        self.resolving = False
+        self.eof = False
+        self.events = {}
+
+        self.client.conn.setblocking(False)
+        logger.info(f'{self.client} Conectado')
+
+        self.update()
+
+    @property
+    def connecting(self) -> bool:
+        return self.connect_deadline is not None
+
+    def _process_request(self, data: bytes) -> None:
+        if self.server:
+            self.server.queue(data)
+            return
+
+        host, port = self._parse_target(data)
+
+        self.server = Server.of((host, port))
+        self.server.conn.setblocking(False)
+
+        self.port = port
+        self.connect_deadline = time.monotonic() + self.CONNECT_TIMEOUT
+        self.loop.connecting.add(self)
+
+        try:
+            socket.inet_pton(socket.AF_INET, host)
+        except OSError:
+            # getaddrinfo blocks, so names are resolved off the loop and the deadline covers both
+            self.resolving = True
+            self._resolve(host, port)
+            return
+
+        self._connect((host, port))
+
+    def _resolve(self, host: str, port: int) -> None:
+        if Tunnel.resolver is None:
+            Tunnel.resolver = ThreadPoolExecutor(self.RESOLVER_WORKERS, 'resolver')
+
+        future = Tunnel.resolver.submit(
+            socket.getaddrinfo, host, port, socket.AF_INET, socket.SOCK_STREAM
+        )
+        future.add_done_callback(
+            lambda future: self.loop.call_soon_threadsafe(partial(self._on_resolved, future))
+        )
+
+    def _on_resolved(self, future: Future) -> None:
+        if self.client.closed:
+            return
+
+        try:
+            addr = future.result()[0][4]
+
+            self.resolving = False
+            self._connect(addr)
+            self.update()
+        except Exception as e:
+            self.close(e)
+
+    def _connect(self, addr: Tuple[str, int]) -> None:
+        # Connect without blocking the loop; the tunnel is told when the socket becomes writable
+        error = self.server.conn.connect_ex(addr)
+        if error not in (0, errno.EINPROGRESS):
+            raise ConnectionError(os.strerror(error))
+
+    def _finish_connect(self) -> None:
+        error = self.server.conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise ConnectionError(os.strerror(error))
+
+        self.connect_deadline = None
+        self.loop.connecting.discard(self)
+
+        logger.info(f'{self.server} Conexão estabelecida')
+        self._on_connected(self.port)
+
+    def check_timeout(self, now: float) -> None:
+        if self.connecting and now > self.connect_deadline:
+            self.close(TimeoutError('Tempo de conexão esgotado'))
+
+    @staticmethod
+    def _flush(connection: Connection) -> None:
+        try:
+            connection.flush()
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            pass
+
+    def _drain(self, source: Connection, target: Optional[Connection]) -> None:
+        # SSL sockets can hold decrypted bytes that epoll does not report
+        while True:
+            try:
+                if target is None:
+                    data = source.read()
+                    received = len(data) if data is not None else None
+
+                    if data:
+                        self._process_request(data)
+                else:
+                    received = target.receive_from(source)
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+
+            if received is None:
+                self.eof = True
+                return
+
+            if (
+                not isinstance(source.conn, ssl.SSLSocket)
+                or not source.conn.pending()
+                or (target is not None and target.congested)
+            ):
+                return
+
+    def on_client(self, mask: int) -> None:
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self._flush(self.client)
+
+            if mask & selectors.EVENT_READ:
+                self._drain(self.client, self.server)
+
+            self.update()
+        except Exception as e:
+            self.close(e)
+
+    def on_server(self, mask: int) -> None:
+        try:
+            if self.connecting:
+                self._finish_connect()
+
+            elif mask & selectors.EVENT_WRITE:
+                self._flush(self.server)
+
+            if mask & selectors.EVENT_READ:
+                self._drain(self.server, self.client)
+
+            self.update()
+        except Exception as e:
+            self.close(e)
+
+    def _set_events(self, connection: Connection, events: int, callback) -> None:
+        if self.events.get(connection) != events:
+            self.events[connection] = events
+            self.loop.set_events(connection.conn, events, callback)
+
+    def update(self) -> None:
+        server = self.server
+
+        # After either side hangs up, deliver what is already queued and then close
+        if self.eof and not self.connecting:
+            if not self.client.pending and not (server and server.pending):
+                self.close()
+                return
+
+        events = 0
+        if not self.eof and not (server and server.congested):
+            events |= selectors.EVENT_READ
+        if self.client.pending:
+            events |= selectors.EVENT_WRITE
+
+        self._set_events(self.client, events, self.on_client)
+
+        if server is None or self.resolving:
+            return
+
+        if self.connecting:
+            events = selectors.EVENT_WRITE
+        else:
+            events = 0
+            if not self.eof and not self.client.congested:
+                events |= selectors.EVENT_READ
+            if server.pending:
+                events |= selectors.EVENT_WRITE
+
+        self._set_events(server, events, self.on_server)
+
+    def close(self, error: Exception = None) -> None:
+        if self.client.closed:
+            return
+
+        if error is not None:
+            logger.error(f'{self.client} Erro: {error}')
+
+        self.loop.connecting.discard(self)
+
+        for connection in (self.client, self.server):
+            if connection is not None and not connection.closed:
+                self.loop.unregister(connection.conn)
+                connection.close()
+
+        self._count_closed(error)
+        logger.info(f'{self.client} Desconectado')
+
+
+class Handshake:
+    TIMEOUT = 10
+
+    def __init__(self, loop: EventLoop, conn: ssl.SSLSocket, addr: Tuple[str, int]) -> None:
+        self.loop = loop
+        self.conn = conn
+        self.addr = addr
+        self.deadline = time.monotonic() + self.TIMEOUT
+
+        self.loop.connecting.add(self)
+        self.loop.register(conn, selectors.EVENT_READ, self.on_event)
+
+    def on_event(self, mask: int) -> None:
+        try:
+            self.conn.do_handshake()
+        except ssl.SSLWantReadError:
+            self.loop.set_events(self.conn, selectors.EVENT_READ, self.on_event)
+            return
+        except ssl.SSLWantWriteError:
+            self.loop.set_events(self.conn, selectors.EVENT_WRITE, self.on_event)
+            return
+        except OSError as e:
+            self.close(e)
+            return
+
+        self.loop.connecting.discard(self)
+        self.loop.unregister(self.conn)
+
+        tunnel = Tunnel(self.loop, Client(self.conn, self.addr))
+
+        # The first request may have been decrypted along with the end of the handshake
+        if self.conn.pending():
+            tunnel.on_client(selectors.EVENT_READ)
+
+    def check_timeout(self, now: float) -> None:
+        if now > self.deadline:
+            self.close(TimeoutError('Tempo de handshake esgotado'))
+
+    def close(self, error: Exception) -> None:
+        logger.error(f'Cliente - {self.addr[0]}:{self.addr[1]} Erro: {error}')
+
+        self.loop.connecting.discard(self)
+        self.loop.unregister(self.conn)
+        self.conn.close()
+
+
 class TCP:
-    def __init__(self, addr: Tuple[str, int] = None, backlog: int = 5):
+    def __init__(
+        self,
+        addr: Tuple[str, int] = None,
+        backlog: int = socket.SOMAXCONN,
+        engine: str = 'threads',
+        reuse_port: bool = False,
+    ):
         self.__addr = addr
         self.__backlog = backlog
+        self.__engine = engine
+        self.__running = False
+        self.__grace = None
 
         self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        # Every worker binds its own socket on the same port and the kernel spreads connections
+        if reuse_port:
+            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.loop = EventLoop() if engine == 'epoll' else None
+
     def handle(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
         raise NotImplementedError()
 
+    def __accept(self, mask: int) -> None:
+        while True:
+            try:
+                conn, addr = self.__sock.accept()
+            except BlockingIOError:
+                return
+
+            self.handle(conn, addr)
+
+    def stop(self, grace: float = 0) -> None:
+        self.__running = False
+        self.__grace = grace
+
+        if self.loop is not None:
+            self.loop.stop()
+
+    def __drain(self) -> None:
+        # Connections already queued on this socket would be reset when it closes
+        self.__sock.setblocking(False)
+        self.__accept(selectors.EVENT_READ)
+        self.__sock.close()
+
+        deadline = time.monotonic() + self.__grace
+
+        if STATS is not None and STATS.active > 0:
+            logger.info(f'Aguardando {STATS.active} conexões por até {self.__grace:.0f}s')
+
+        while STATS is not None and STATS.active > 0 and time.monotonic() < deadline:
+            if self.loop is not None:
+                self.loop.run_once()
+            else:
+                time.sleep(0.1)
+
     def run(self) -> None:
         self.__sock.bind(self.__addr)
         self.__sock.listen(self.__backlog)
 
-        logger.info(f'Servidor iniciado em {self.__addr[0]}:{self.__addr[1]}')
+        logger.info(f'Servidor iniciado em {self.__addr[0]}:{self.__addr[1]} ({self.__engine})')
+
+        self.__running = True
 
         try:
-            while True:
-                conn, addr = self.__sock.accept()
-                self.handle(conn, addr)
+            if self.loop is not None:
+                self.__sock.setblocking(False)
+                self.loop.register(self.__sock, selectors.EVENT_READ, self.__accept)
+                self.loop.run()
+            else:
+                # Wake up every second to notice stop()
+                self.__sock.settimeout(1)
+
+                while self.__running:
+                    try:
+                        conn, addr = self.__sock.accept()
+                    except socket.timeout:
+                        continue
+
+                    self.handle(conn, addr)
         except KeyboardInterrupt:
             pass
         finally:
             logger.info('Finalizando servidor...')
+
+            if self.loop is not None:
+                self.loop.unregister(self.__sock)
+
+            if self.__grace is not None:
+                self.__drain()
+
             self.__sock.close()
 
 
 class HTTP(TCP):
     def handle(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
         client = Client(conn, addr)
+
+        if self.loop is not None:
+            Tunnel(self.loop, client)
+            return
+
         proxy = Proxy(client)
         proxy.daemon = True
         proxy.start()
 
 
 class HTTPS(TCP):
-    def __init__(self, addr: Tuple[str, int], cert: str, backlog: int = 5) -> None:
-        super().__init__(addr, backlog)
-
-        self.__cert = cert
-
-    def handle_thread(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
-        conn = ssl.wrap_socket(
-            sock=conn,
-            keyfile=self.__cert,
-            certfile=self.__cert,
-            server_side=True,
-            ssl_version=ssl.PROTOCOL_TLSv1_2,
-        )
+    def __init__(
+        self,
+        addr: Tuple[str, int],
+        cert: str,
+        backlog: int = socket.SOMAXCONN,
+        engine: str = 'threads',
+        reuse_port: bool = False,
+        context: ssl.SSLContext = None,
+    ) -> None:
+        super().__init__(addr, backlog, engine, reuse_port)
+
+        self.__context = context or self.create_context(cert)
+
+    @staticmethod
+    def create_context(cert: str) -> ssl.SSLContext:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(certfile=cert, keyfile=cert)
+
+        # Resumed sessions skip the certificate signature, the expensive part of a handshake
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = 2
+
+        return context
 
-        client = Client(conn, addr)
-        proxy = Proxy(client)
+    def handle(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
+        if self.loop is not None:
+            conn.setblocking(False)
+
+        # The TLS 1.3 tickets and the 101 response are small writes that Nagle would hold back
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        try:
+            conn = self.__context.wrap_socket(
+                conn, server_side=True, do_handshake_on_connect=False
+            )
+        except OSError as e:
+            logger.error(f'Cliente - {addr[0]}:{addr[1]} Erro: {e}')
+            conn.close()
+            return
+
+        if self.loop is not None:
+            Handshake(self.loop, conn, addr)
+            return
+
+        proxy = Proxy(Client(conn, addr))
         proxy.daemon = True
         proxy.start()
 
-    def handle(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
-        thread = threading.Thread(target=self.handle_thread, args=(conn, addr))
-        thread.daemon = True
-        thread.start()
+
+class Supervisor:
+    STATS_INTERVAL = 60
+
+    def __init__(self, factory: Callable[[], TCP], workers: int, grace: float) -> None:
+        self.factory = factory
+        self.workers = workers
+        self.grace = grace
+
+        self.children: Dict[int, int] = {}
+        self.retiring: Dict[int, int] = {}
+
+        self.__running = False
+        self.__restart = False
+        self.__report = False
+
+    def __free_slot(self) -> int:
+        used = set(self.children.values()) | set(self.retiring.values())
+        return next(slot for slot in range(STATS.slots) if slot not in used)
+
+    def __serve(self, slot: int) -> None:
+        server = None
+
+        def stop(signum, frame):
+            if server is None:
+                os._exit(0)
+
+            server.stop(self.grace)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+        STATS.slot = slot
+        server = self.factory()
+        server.run()
+
+    def spawn(self) -> int:
+        slot = self.__free_slot()
+        STATS.reset(slot)
+
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self.__serve(slot)
+            except BaseException as e:
+                logger.error(f'Worker {os.getpid()} Erro: {e}')
+                code = 1
+            finally:
+                os._exit(code)
+
+        self.children[pid] = slot
+        logger.info(f'Worker {pid} iniciado')
+        return pid
+
+    def restart(self) -> None:
+        if self.retiring:
+            logger.warning('Reinício anterior ainda em andamento')
+            return
+
+        # New workers start listening before the old ones stop accepting
+        self.retiring, self.children = self.children, {}
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        for pid in self.retiring:
+            self.__signal(pid, signal.SIGTERM)
+
+        logger.info(f'Reiniciando {len(self.retiring)} workers')
+
+    def report(self) -> None:
+        summary = STATS.summary()
+        logger.info(
+            f'Conexões: {summary["active"]} ativas, {summary["total"]} aceitas, '
+            f'{summary["errors"]} erros ({len(self.children)} workers)'
+        )
+
+    @staticmethod
+    def __signal(pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def __reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            if pid in self.retiring:
+                STATS.reset(self.retiring.pop(pid))
+                logger.info(f'Worker {pid} finalizado')
+                continue
+
+            if pid not in self.children:
+                continue
+
+            STATS.reset(self.children.pop(pid))
+            logger.warning(f'Worker {pid} saiu com código {os.waitstatus_to_exitcode(status)}')
+
+            if self.__running:
+                self.spawn()
+
+    def __handle_signal(self, signum, frame) -> None:
+        if signum == signal.SIGHUP:
+            self.__restart = True
+        elif signum == signal.SIGUSR1:
+            self.__report = True
+        else:
+            self.__running = False
+
+    def run(self) -> None:
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(signum, self.__handle_signal)
+
+        self.__running = True
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        next_report = time.monotonic() + self.STATS_INTERVAL
+
+        try:
+            while self.__running:
+                time.sleep(1)
+                self.__reap()
+
+                if self.__restart:
+                    self.__restart = False
+                    self.restart()
+
+                if self.__report or time.monotonic() >= next_report:
+                    self.__report = False
+                    next_report = time.monotonic() + self.STATS_INTERVAL
+                    self.report()
+        finally:
+            logger.info('Finalizando workers...')
+            self.stop()
+
+    def stop(self) -> None:
+        self.__running = False
+        self.retiring.update(self.children)
+        self.children.clear()
+
+        for pid in self.retiring:
+            self.__signal(pid, signal.SIGTERM)
+
+        # Workers get the grace period to drain, then whatever is left is killed
+        deadline = time.monotonic() + self.grace + 5
+
+        while self.retiring and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self.__reap()
+
+        for pid in list(self.retiring):
+            self.__signal(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            STATS.reset(self.retiring.pop(pid))
 
 
 def main():
-    global REMOTE_ADDRESS
+    global REMOTE_ADDRESS, RELAY_MODE, STATS
     
     parser = argparse.ArgumentParser(description='Proxy', usage='%(prog)s [options]')
 
     parser.add_argument('--host', default='0.0.0.0', help='Host')
     parser.add_argument('--port', type=int, default=8080, help='Port')
-    parser.add_argument('--backlog', type=int, default=5, help='Backlog')
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN, help='Backlog')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Processos que aceitam conexões na mesma porta com SO_REUSEPORT',
+    )
+    parser.add_argument(
+        '--grace',
+        type=float,
+        default=30,
+        help='Segundos para as conexões terminarem ao reiniciar ou finalizar os workers',
+    )
+    parser.add_argument(
+        '--relay',
+        default=RELAY_MODE,
+        choices=['buffered', 'splice'],
+        help='splice: túneis sem TLS copiam os dados no kernel com splice()',
+    )
+    parser.add_argument(
+        '--engine',
+        default='threads',
+        choices=['threads', 'epoll'],
+        help='threads: uma thread por conexão, epoll: um único loop de eventos',
+    )
     parser.add_argument(
         '-r', '--remote', default='%s:%d' % (REMOTE_ADDRESS), help='Remote address, ex: 0.0.0.0:8080'
     )
@@ -380,22 +1235,40 @@ def main():
     if args.remote:
         REMOTE_ADDRESS = args.remote.split(':')[0], int(args.remote.split(':')[1])
 
+    if args.relay == 'splice' and not SPLICE_SUPPORTED:
+        logger.warning('splice() indisponível neste sistema, usando cópia em buffer')
+    RELAY_MODE = args.relay
+
+    reuse_port = args.workers > 1
+
     if args.http:
-        server = HTTP((args.host, args.port), args.backlog)
+        factory = partial(HTTP, (args.host, args.port), args.backlog, args.engine, reuse_port)
     elif args.https:
         if not os.path.exists(args.cert):
             raise FileNotFoundError(f'Certicado {args.cert} não encontrado')
-        server = HTTPS((args.host, args.port), args.cert, args.backlog)
+        # Loaded once before forking, so every worker accepts the others' session tickets
+        context = HTTPS.create_context(args.cert)
+        factory = partial(
+            HTTPS, (args.host, args.port), args.cert, args.backlog, args.engine, reuse_port, context
+        )
     else:
         parser.print_help()
         return
 
     logging.basicConfig(
         level=getattr(logging, args.log.upper()),
-        format='[%(asctime)s] %(levelname)s: %(message)s',
+        format='[%(asctime)s] %(process)d %(levelname)s: %(message)s'
+        if reuse_port
+        else '[%(asctime)s] %(levelname)s: %(message)s',
     )
 
-    server.run()
+    # Old and new workers overlap during a restart, so each one needs its own slot
+    STATS = Stats(args.workers * 2)
+
+    if args.workers > 1:
+        Supervisor(factory, args.workers, args.grace).run()
+    else:
+        factory().run()
 
 
 if __name__ == '__main__':
@@ -5,16 +5,28 @@ import typing as t
 import os
 import sys
 import json
+import re
+import time
+import pwd
+import grp
+import stat
+import bisect
+import struct
 
 import socket
 import threading
 import queue
+import mmap
+import selectors
+import signal
 
 import logging
 import argparse
 
-from datetime import datetime
-from urllib.parse import urlparse
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import MappingProxyType
 
 __author__ = '@DuTra01'
 __version__ = '2.1.4'
@@ -27,15 +39,339 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-class OpenVPNManager:
-    def __init__(self, port: int = 7505):
+class Session(t.NamedTuple):
+    kind: str
+    id: int
+    username: str
+    started_at: float
+
+
+def select_sessions(sessions: t.Iterable[Session], selection: str = 'all') -> t.List[Session]:
+    mode, _, value = selection.lower().partition(':')
+
+    if mode == 'all':
+        return list(sessions)
+
+    if mode in ('oldest', 'newest'):
+        count = int(value) if value else 1
+        if count < 1:
+            return []
+
+        ordered = sorted(sessions, key=lambda session: session.started_at)
+        return ordered[:count] if mode == 'oldest' else ordered[-count:]
+
+    if mode in ('ssh', 'openvpn') and value:
+        return [
+            session for session in sessions if session.kind == mode and str(session.id) == value
+        ]
+
+    raise ValueError('Invalid session selection: %s' % selection)
+
+
+class OpenVPNClient(t.NamedTuple):
+    common_name: str
+    real_address: str
+    virtual_address: str
+    connected_since: float
+    username: str
+    client_id: t.Optional[int]
+
+
+class OpenVPNManagementClient(threading.Thread):
+    STATUS_COMMAND = 'status 2'
+    COMMAND_TIMEOUT = 2.0
+    ONESHOT_TIMEOUT = 1.0
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, port: int = 7505, host: str = 'localhost', refresh_interval: float = 5.0):
+        super(OpenVPNManagementClient, self).__init__()
+        self.daemon = True
+
+        self.host = host
         self.port = port
-        self.config_path = '/etc/openvpn/'
+        self.refresh_interval = refresh_interval
+
+        self.clients = {}
+        self.updated_at = 0.0
+
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._gave_up = False
+        self._waiters = []
+
+        self._pending = None
+        self._header = {}
+        self._refresh_pending = False
+        self._last_refresh = 0.0
+
+    @classmethod
+    def get_instance(cls, port: int = 7505) -> 'OpenVPNManagementClient':
+        with cls._instances_lock:
+            client = cls._instances.get(port)
+            if client is None:
+                client = cls._instances[port] = cls(port)
+                client.start()
+
+        return client
+
+    @property
+    def is_connected(self) -> bool:
+        return self._sock is not None
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.updated_at < self.refresh_interval * 3
+
+    def wait_ready(self, timeout: float = 2.0) -> bool:
+        if self._ready.is_set():
+            return True
+
+        # OpenVPN serves one management client at a time, so only the first caller waits for it
+        if self._gave_up:
+            return False
+
+        ready = self._ready.wait(timeout)
+        self._gave_up = not ready
+        return ready
+
+    def send_command(self, command: str) -> bool:
+        with self._send_lock:
+            if self._sock is None:
+                return False
+
+            try:
+                self._sock.sendall(command.encode() + b'\n')
+                return True
+            except OSError:
+                return False
+
+    def execute(self, command: str, timeout: float = None) -> t.Optional[str]:
+        waiter = [threading.Event(), None]
+
+        with self._send_lock:
+            if self._sock is None:
+                return None
+
+            try:
+                self._waiters.append(waiter)
+                self._sock.sendall(command.encode() + b'\n')
+            except OSError:
+                self._waiters.remove(waiter)
+                return None
+
+        # A late reply still pops its own waiter, so replies stay matched to commands in order
+        if not waiter[0].wait(timeout or self.COMMAND_TIMEOUT):
+            return None
+
+        return waiter[1]
+
+    def set_reply(self, line: t.Optional[str]) -> None:
+        with self._send_lock:
+            waiter = self._waiters.pop(0) if self._waiters else None
+
+        if waiter is not None:
+            waiter[1] = line
+            waiter[0].set()
+
+    def request(self, command: str, timeout: float = None) -> t.Optional[str]:
+        timeout = timeout or self.ONESHOT_TIMEOUT
+        deadline = time.monotonic() + timeout
+
+        try:
+            with socket.create_connection((self.host, self.port), timeout=timeout) as sock:
+                sock.sendall(command.encode() + b'\n')
+                buffer = b''
+
+                while True:
+                    sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                    data = sock.recv(4096)
+                    if not data:
+                        return None
+
+                    buffer += data
+                    *lines, buffer = buffer.split(b'\n')
+                    for line in lines:
+                        line = line.rstrip(b'\r').decode('utf-8', 'replace')
+                        if line.startswith('SUCCESS:') or line.startswith('ERROR:'):
+                            return line
+
+                        self.process_line(line)
+                        if line == 'END':
+                            return line
+        except OSError as e:
+            logger.debug('OpenVPN management unavailable: %s' % e)
+            return None
+
+    def fetch_table(self, timeout: float = None) -> t.Optional[t.Dict[str, t.List[OpenVPNClient]]]:
+        if self.request(self.STATUS_COMMAND, timeout) != 'END':
+            return None
+
+        return self.clients
+
+    def refresh(self) -> bool:
+        self._last_refresh = time.monotonic()
+        return self.send_command(self.STATUS_COMMAND)
+
+    def get_table(self) -> t.Optional[t.Dict[str, t.List[OpenVPNClient]]]:
+        if not self.wait_ready() or not self.is_connected or not self.is_fresh:
+            return None
+
+        return self.clients
+
+    def parse_client(self, fields: t.List[str]) -> OpenVPNClient:
+        def get(name: str, default: str = '') -> str:
+            index = self._header.get(name)
+            return fields[index] if index is not None and index < len(fields) else default
+
+        client_id = get('Client ID')
+        connected_since = get('Connected Since (time_t)', '0')
+
+        return OpenVPNClient(
+            common_name=get('Common Name', fields[1] if len(fields) > 1 else ''),
+            real_address=get('Real Address'),
+            virtual_address=get('Virtual Address'),
+            connected_since=float(connected_since) if connected_since.isdigit() else 0.0,
+            username=get('Username', 'UNDEF'),
+            client_id=int(client_id) if client_id.isdigit() else None,
+        )
+
+    def process_line(self, line: str) -> None:
+        if line.startswith('>CLIENT:'):
+            event = line[8:].split(',', 1)[0]
+            if event in ('ESTABLISHED', 'DISCONNECT'):
+                self._refresh_pending = True
+            elif event == 'ENV' and line.endswith(',END') and self._refresh_pending:
+                self._refresh_pending = False
+                self.refresh()
+            return
+
+        if line.startswith('SUCCESS:') or line.startswith('ERROR:'):
+            logger.debug('OpenVPN management: %s' % line)
+            self.set_reply(line)
+            return
+
+        if line.startswith('>'):
+            logger.debug('OpenVPN management: %s' % line)
+            return
+
+        if line.startswith('TITLE,'):
+            self._pending = {}
+            return
+
+        if self._pending is None:
+            return
+
+        if line.startswith('HEADER,CLIENT_LIST,'):
+            names = line.split(',')[1:]
+            self._header = {name: index for index, name in enumerate(names)}
+            return
+
+        if line.startswith('CLIENT_LIST,'):
+            client = self.parse_client(line.split(','))
+            self._pending.setdefault(client.common_name, []).append(client)
+
+            if client.username not in ('UNDEF', '', client.common_name):
+                self._pending.setdefault(client.username, []).append(client)
+            return
+
+        if line == 'END':
+            self.clients = self._pending
+            self.updated_at = time.monotonic()
+            self._pending = None
+            self._ready.set()
+
+    def connect(self) -> None:
+        sock = socket.create_connection((self.host, self.port), timeout=self.refresh_interval)
+        sock.settimeout(self.refresh_interval)
+
+        with self._send_lock:
+            self._sock = sock
+
+        self._pending = None
+        self.refresh()
+
+    def disconnect(self) -> None:
+        with self._send_lock:
+            sock, self._sock = self._sock, None
+            waiters, self._waiters = self._waiters, []
+
+        for waiter in waiters:
+            waiter[0].set()
+
+        if sock is not None:
+            sock.close()
+
+    def read_lines(self) -> None:
+        buffer = b''
+
+        while True:
+            try:
+                data = self._sock.recv(4096)
+            except socket.timeout:
+                data = None
+
+            if data == b'':
+                raise ConnectionError('Management interface closed the connection')
+
+            if data:
+                buffer += data
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    self.process_line(line.rstrip(b'\r').decode('utf-8', 'replace'))
+
+            if time.monotonic() - self._last_refresh >= self.refresh_interval:
+                self.refresh()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.connect()
+                self.read_lines()
+            except OSError as e:
+                logger.debug('OpenVPN management unavailable: %s' % e)
+            finally:
+                self.disconnect()
+                self._ready.set()
+
+            time.sleep(self.refresh_interval)
+
+
+class OpenVPNManager:
+    MANAGEMENT_PORT = 7505
+    CONFIG_PATH = '/etc/openvpn/'
+    LOG_PATH = '/var/log/openvpn/'
+
+    # persistent: the daemon keeps the single management connection OpenVPN allows
+    # oneshot: CLI calls open a short-lived connection with a timeout
+    # shared: worker processes read the table the supervisor publishes and never connect
+    # log: CLI checks read the status log and leave the management port alone
+    PERSISTENT = 'persistent'
+    ONESHOT = 'oneshot'
+    SHARED = 'shared'
+    LOG = 'log'
+    MODE = ONESHOT
+
+    def __init__(self, port: int = None):
+        self.port = port or self.MANAGEMENT_PORT
+        self.config_path = self.CONFIG_PATH
         self.config_file = 'server.conf'
         self.log_file = 'openvpn.log'
-        self.log_path = '/var/log/openvpn/'
+        self.log_path = self.LOG_PATH
+
+        if self.MODE == self.SHARED:
+            self.management = None
+        elif self.MODE == self.PERSISTENT:
+            self.start_manager()
+            self.management = OpenVPNManagementClient.get_instance(self.port)
+        else:
+            self.start_manager()
+            self.management = OpenVPNManagementClient(self.port)
 
-        self.start_manager()
+        self._table = None
+        self._fetched = False
 
     @property
     def config(self) -> str:
@@ -47,13 +383,7 @@ class OpenVPNManager:
         if os.path.exists(path):
             return path
 
-        self.log_path = 'openvpn-status.log'
-        return os.path.join(self.config_path, self.log_file)
-
-    def create_connection(self) -> socket.socket:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(('localhost', self.port))
-        return sock
+        return os.path.join(self.config_path, 'openvpn-status.log')
 
     def start_manager(self) -> None:
         if os.path.exists(self.config):
@@ -71,235 +401,1072 @@ class OpenVPNManager:
 
             os.system('service openvpn restart')
 
-    def count_connection_from_manager(self, username: str) -> int:
-        try:
-            soc = self.create_connection()
-            soc.send(b'status\n')
+    def get_table(self) -> t.Optional[t.Dict[str, t.List[OpenVPNClient]]]:
+        if self.MODE == self.PERSISTENT:
+            return self.management.get_table()
 
-            data = b''
-            buf = data
+        if self.MODE == self.SHARED:
+            collector = StateCollector.instance
+            if collector is None or not collector.is_fresh:
+                return None
+            return collector.openvpn_clients
 
-            while b'\r\nEND\r\n' not in buf:
-                buf = soc.recv(1024)
-                data += buf
+        if self.MODE == self.LOG:
+            return None
 
-            soc.close()
-            count = data.count(username.encode())
-            return count // 2 if count > 0 else 0
-        except Exception:
-            return -1
+        # One status request per manager, shared by the count and the session list
+        if not self._fetched:
+            self._table = self.management.fetch_table()
+            self._fetched = True
+
+        return self._table
+
+    def execute(self, command: str) -> bool:
+        if self.MODE == self.SHARED:
+            logger.warning('OpenVPN management is owned by the supervisor, "%s" skipped' % command)
+            return False
+
+        if self.MODE == self.PERSISTENT:
+            reply = self.management.execute(command)
+        else:
+            reply = self.management.request(command)
+
+        if reply is None or not reply.startswith('SUCCESS:'):
+            logger.warning('OpenVPN management did not confirm "%s": %s' % (command, reply))
+            return False
+
+        return True
+
+    def count_connection_from_manager(self, username: str) -> int:
+        clients = self.get_table()
+        return len(clients.get(username, [])) if clients is not None else -1
+
+    def get_log_counts(self) -> t.Dict[str, int]:
+        return OpenVPNStatusIndex.get_instance(self.log).load()
 
     def count_connection_from_log(self, username: str) -> int:
-        if os.path.exists(self.log):
-            with open(self.log, 'r') as f:
-                data = f.read()
-                count = data.count(username)
-                return count // 2 if count > 0 else 0
-        return 0
+        return self.get_log_counts().get(username, 0)
 
     def count_connections(self, username: str) -> int:
         count = self.count_connection_from_manager(username)
         return count if count > -1 else self.count_connection_from_log(username)
 
-    def kill_connection(self, username: str) -> None:
-        soc = self.create_connection()
-        soc.send(b'kill %s\n' % username.encode())
-        soc.close()
+    def get_sessions(self, username: str) -> t.List[Session]:
+        clients = self.get_table() or {}
+        return [
+            Session('openvpn', client.client_id, username, client.connected_since)
+            for client in clients.get(username, [])
+            if client.client_id is not None
+        ]
 
+    def kill_client(self, client_id: int) -> bool:
+        return self.execute('client-kill %d' % client_id)
 
-class SSHManager:
-    def count_connections(self, username: str) -> int:
-        command = 'ps -u %s' % username
-        result = os.popen(command).readlines()
-        return len([line for line in result if 'sshd' in line])
+    def kill_connection(self, username: str) -> bool:
+        return self.execute('kill %s' % username)
 
-    def get_pids(self, username: str) -> t.List[int]:
-        command = 'ps -u %s' % username
-        result = os.popen(command).readlines()
-        return [int(line.split()[0]) for line in result if 'sshd' in line]
 
-    def kill_connection(self, username: str) -> None:
-        pids = self.get_pids(username)
-        for pid in pids:
-            os.kill(pid, 9)
+class ProcessInfo(t.NamedTuple):
+    pid: int
+    uid: int
+    name: str
+    start_time: float
+    ppid: int = 0
 
 
-class CheckerUserManager:
-    def __init__(self, username: str):
-        self.username = username
-        self.ssh_manager = SSHManager()
-        self.openvpn_manager = OpenVPNManager()
+class ProcSnapshot:
+    def __init__(self, sessions: t.Dict[int, t.List[ProcessInfo]], created_at: float):
+        self.sessions = sessions
+        self.created_at = created_at
 
-    def get_expiration_date(self) -> t.Optional[str]:
-        command = 'chage -l %s' % self.username
-        result = os.popen(command).readlines()
+    def get_sessions(self, uid: int) -> t.List[ProcessInfo]:
+        return self.sessions.get(uid, [])
 
-        for line in result:
-            line = list(map(str.strip, line.split(':')))
-            if line[0].lower() == 'account expires' and line[1] != 'never':
-                return datetime.strptime(line[1], '%b %d, %Y').strftime('%d/%m/%Y')
 
-        return None
+class ProcScanner:
+    PROC_PATH = '/proc'
+    PROCESS_NAME = 'sshd'
 
-    def get_expiration_days(self, date: str) -> int:
-        if not isinstance(date, str) or date.lower() == 'never' or not isinstance(date, str):
-            return -1
+    _instance = None
+    _instance_lock = threading.Lock()
 
-        return (datetime.strptime(date, '%d/%m/%Y') - datetime.now()).days
+    def __init__(self, refresh_interval: float = 1.0):
+        self.refresh_interval = refresh_interval
 
-    def get_connections(self) -> int:
-        return self.ssh_manager.count_connections(
-            self.username
-        ) + self.openvpn_manager.count_connections(self.username)
+        self._snapshot = None
+        self._lock = threading.Lock()
 
-    def get_time_online(self) -> t.Optional[str]:
-        command = 'ps -u %s -o etime --no-headers' % self.username
-        result = os.popen(command).readlines()
-        return result[0].strip() if result else None
+        self._clock_ticks = os.sysconf('SC_CLK_TCK')
+        self._boot_time = None
 
-    def get_limiter_connection(self) -> int:
-        path = '/root/usuarios.db'
+    @classmethod
+    def get_instance(cls) -> 'ProcScanner':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
 
-        if os.path.exists(path):
-            with open(path) as f:
+        return cls._instance
+
+    @property
+    def boot_time(self) -> float:
+        if self._boot_time is None:
+            with open(os.path.join(self.PROC_PATH, 'stat')) as f:
                 for line in f:
-                    split = line.strip().split()
-                    if len(split) == 2 and split[0] == self.username:
-                        return int(split[1].strip())
+                    if line.startswith('btime'):
+                        self._boot_time = float(line.split()[1])
+                        break
+                else:
+                    self._boot_time = 0.0
 
-        return -1
+        return self._boot_time
 
-    def kill_connection(self) -> None:
-        self.ssh_manager.kill_connection(self.username)
-        self.openvpn_manager.kill_connection(self.username)
+    def read_process(self, pid: int) -> t.Optional[ProcessInfo]:
+        path = os.path.join(self.PROC_PATH, str(pid))
 
+        try:
+            with open(os.path.join(path, 'stat'), 'rb') as f:
+                stat = f.read()
 
-class CheckerUserConfig:
-    CONFIG_FILE = 'config.json'
-    PATH_CONFIG = '/etc/checker/'
-    PATH_CONFIG_OPTIONAL = os.path.join(os.path.expanduser('~'), 'checker')
+            # comm may contain spaces or parentheses, so split around the last ')'
+            name = stat[stat.index(b'(') + 1 : stat.rindex(b')')].decode('utf-8', 'replace')
+            if self.PROCESS_NAME not in name:
+                return None
 
-    def __init__(self):
-        self.config = self.load_config()
+            fields = stat[stat.rindex(b')') + 2 :].split()
+            ppid = int(fields[1])
+            start_time = self.boot_time + int(fields[19]) / self._clock_ticks
 
-    @property
-    def path_config(self) -> str:
-        path = os.path.join(self.PATH_CONFIG, self.CONFIG_FILE)
+            with open(os.path.join(path, 'status'), 'rb') as f:
+                for line in f:
+                    if line.startswith(b'Uid:'):
+                        uid = int(line.split()[2])
+                        break
+                else:
+                    return None
+        except (OSError, ValueError, IndexError):
+            return None
+
+        return ProcessInfo(pid, uid, name, start_time, ppid)
+
+    def scan(self) -> ProcSnapshot:
+        sessions = {}
+
+        for entry in os.listdir(self.PROC_PATH):
+            if not entry.isdigit():
+                continue
+
+            process = self.read_process(int(entry))
+            if process is not None:
+                sessions.setdefault(process.uid, []).append(process)
+
+        for processes in sessions.values():
+            processes.sort(key=lambda process: process.pid)
+
+        return ProcSnapshot(sessions, time.monotonic())
+
+    def snapshot(self) -> ProcSnapshot:
+        snapshot = self._snapshot
+        if snapshot and time.monotonic() - snapshot.created_at < self.refresh_interval:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if not snapshot or time.monotonic() - snapshot.created_at >= self.refresh_interval:
+                snapshot = self._snapshot = self.scan()
+
+        return snapshot
+
+
+class SSHManager:
+    def __init__(self, scanner: ProcScanner = None):
+        self.scanner = scanner or ProcScanner.get_instance()
+
+    @staticmethod
+    def get_uid(username: str) -> t.Optional[int]:
+        uid = PasswdIndex.get_instance().get(username)
+        if uid is not None:
+            return uid
 
         try:
-            if not os.path.exists(path):
-                os.makedirs(self.PATH_CONFIG, exist_ok=True)
-        except PermissionError:
-            path = os.path.join(self.PATH_CONFIG_OPTIONAL, self.CONFIG_FILE)
+            return pwd.getpwnam(username).pw_uid
+        except KeyError:
+            return None
 
-            if not os.path.exists(path):
-                os.makedirs(self.PATH_CONFIG_OPTIONAL, exist_ok=True)
+    def get_sessions(self, username: str) -> t.List[ProcessInfo]:
+        uid = self.get_uid(username)
+        if uid is None:
+            return []
 
-        return path
+        tracker = AuthLogTracker.instance
+        if tracker is not None and tracker.is_ready:
+            return tracker.get_sessions(username, uid)
 
-    @property
-    def exclude(self) -> t.List[str]:
-        return self.config.get('exclude', [])
+        return self.scanner.snapshot().get_sessions(uid)
 
-    @exclude.setter
-    def exclude(self, value: t.List[str]):
-        self.config['exclude'] = value
-        self.save_config()
+    def count_connections(self, username: str) -> int:
+        tracker = AuthLogTracker.instance
+        if tracker is not None and tracker.is_ready:
+            return tracker.count_connections(username)
 
-    def include(self, name: str) -> bool:
-        if name in self.exclude:
-            self.exclude.remove(name)
-            self.save_config()
+        return len(self.get_sessions(username))
+
+    def get_pids(self, username: str) -> t.List[int]:
+        return [session.pid for session in self.get_sessions(username)]
+
+    @staticmethod
+    def format_time_online(sessions: t.List[ProcessInfo]) -> t.Optional[str]:
+        if not sessions:
+            return None
+
+        elapsed = int(time.time() - min(session.start_time for session in sessions))
+        days, elapsed = divmod(max(elapsed, 0), 86400)
+        hours, elapsed = divmod(elapsed, 3600)
+        minutes, seconds = divmod(elapsed, 60)
+
+        if days:
+            return '%d-%02d:%02d:%02d' % (days, hours, minutes, seconds)
+        if hours:
+            return '%02d:%02d:%02d' % (hours, minutes, seconds)
+        return '%02d:%02d' % (minutes, seconds)
+
+    def get_time_online(self, username: str) -> t.Optional[str]:
+        return self.format_time_online(self.get_sessions(username))
+
+    @staticmethod
+    def kill_pid(pid: int) -> bool:
+        try:
+            os.kill(pid, 9)
             return True
+        except OSError:
+            return False
 
-        return False
+    def kill_connection(self, username: str) -> None:
+        pids = self.get_pids(username)
+        for pid in pids:
+            self.kill_pid(pid)
 
-    @property
-    def port(self) -> int:
-        return self.config.get('port', 5000)
 
-    @port.setter
-    def port(self, value: int):
-        self.config['port'] = value
-        self.save_config()
+class FileIndex:
+    PATH = None
+    LOG_LEVEL = logging.INFO
 
-    def load_config(self) -> dict:
-        default_config = {
-            'exclude': [],
-            'port': 5000,
-        }
+    _instances = {}
+    _instances_lock = threading.Lock()
 
-        if os.path.exists(self.path_config):
-            with open(self.path_config, 'r') as f:
-                data = json.load(f)
-                return data if isinstance(data, dict) else default_config
+    def __init__(self, path: str = None):
+        self.path = path or self.PATH
 
-        return default_config
+        self.data = {}
+        self.reload_count = 0
+        self.reload_time = 0.0
 
-    def save_config(self, config: dict = None):
-        self.config = config or self.config
+        self._signature = None
+        self._lock = threading.Lock()
 
-        with open(self.path_config, 'w') as f:
-            f.write(json.dumps(self.config, indent=4))
+    @classmethod
+    def get_instance(cls, path: str = None) -> 'FileIndex':
+        key = (cls, path or cls.PATH)
 
-    @staticmethod
-    def remove_config() -> None:
-        if os.path.exists(CheckerUserConfig.PATH_CONFIG):
-            os.system('rm -rf %s' % CheckerUserConfig.PATH_CONFIG)
+        with FileIndex._instances_lock:
+            index = FileIndex._instances.get(key)
+            if index is None:
+                index = FileIndex._instances[key] = cls(path)
 
+        return index
 
-class ServiceManager:
-    CONFIG_SYSTEMD_PATH = '/etc/systemd/system/'
-    CONFIG_SYSTEMD = 'user_check.service'
+    def parse(self, f: t.Iterable[str]) -> t.Dict[str, t.Any]:
+        raise NotImplementedError()
 
-    @property
-    def config(self) -> str:
-        return os.path.join(self.CONFIG_SYSTEMD_PATH, self.CONFIG_SYSTEMD)
+    def read(self) -> t.Dict[str, t.Any]:
+        with open(self.path) as f:
+            return self.parse(f)
 
-    @property
-    def is_created(self) -> bool:
-        return os.path.exists(self.config)
+    def get_signature(self) -> t.Optional[t.Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
 
-    @property
-    def is_enabled(self) -> bool:
-        return os.system('systemctl is-enabled %s >/dev/null' % self.CONFIG_SYSTEMD) == 0
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
 
-    def status(self) -> str:
-        command = 'systemctl status %s' % self.CONFIG_SYSTEMD
-        result = os.popen(command).readlines()
-        return ''.join(result)
+    def load(self) -> t.Dict[str, t.Any]:
+        signature = self.get_signature()
+        if signature == self._signature:
+            return self.data
 
-    def start(self):
-        status = self.status()
-        if 'Active: active' not in status:
-            os.system('systemctl start %s' % self.CONFIG_SYSTEMD)
-            return True
+        with self._lock:
+            signature = self.get_signature()
+            if signature == self._signature:
+                return self.data
 
-        logger.info('Service is already running')
-        return False
+            start = time.perf_counter()
+            data = {}
 
-    def stop(self):
-        status = self.status()
-        if 'Active: inactive' not in status:
-            os.system('systemctl stop %s' % self.CONFIG_SYSTEMD)
-            return True
+            if signature is not None:
+                try:
+                    data = self.read()
+                except OSError as e:
+                    logger.error('Failed to load %s: %s' % (self.path, e))
+                    return self.data
 
-        logger.info('Service is already stopped')
-        return False
+            self.data, self._signature = data, signature
+            self.reload_count += 1
+            self.reload_time = time.perf_counter() - start
 
-    def restart(self) -> bool:
-        command = 'systemctl restart %s' % self.CONFIG_SYSTEMD
-        return os.system(command) == 0
+            logger.log(
+                self.LOG_LEVEL,
+                'Loaded %s: %d entries in %.2fms (reload #%d)'
+                % (self.path, len(data), self.reload_time * 1000, self.reload_count)
+            )
 
-    def remove_service(self):
-        os.system('systemctl stop %s' % self.CONFIG_SYSTEMD)
-        os.system('systemctl disable %s' % self.CONFIG_SYSTEMD)
-        os.system('rm %s' % self.config)
-        os.system('systemctl daemon-reload')
+        return self.data
 
-    def create_systemd_config(self):
-        config_template = ''.join(
-            [
+    def get(self, key: str, default: t.Any = None) -> t.Any:
+        return self.load().get(key, default)
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {
+            'path': self.path,
+            'entries': len(self.data),
+            'reload_count': self.reload_count,
+            'reload_time': self.reload_time,
+        }
+
+
+class LimitIndex(FileIndex):
+    PATH = '/root/usuarios.db'
+
+    def parse(self, f: t.Iterable[str]) -> t.Dict[str, int]:
+        limits = {}
+
+        for line in f:
+            split = line.strip().split()
+            if len(split) == 2 and split[0] not in limits:
+                try:
+                    limits[split[0]] = int(split[1])
+                except ValueError:
+                    continue
+
+        return limits
+
+
+class PasswdIndex(FileIndex):
+    PATH = '/etc/passwd'
+
+    def parse(self, f: t.Iterable[str]) -> t.Dict[str, int]:
+        uids = {}
+
+        for line in f:
+            fields = line.split(':')
+            if len(fields) > 2 and fields[2].isdigit():
+                uids.setdefault(fields[0], int(fields[2]))
+
+        return uids
+
+
+class ShadowIndex(FileIndex):
+    PATH = '/etc/shadow'
+
+    def parse(self, f: t.Iterable[str]) -> t.Dict[str, t.Optional[str]]:
+        expirations = {}
+
+        for line in f:
+            fields = line.rstrip('\n').split(':')
+            if len(fields) < 8 or not fields[0]:
+                continue
+
+            expire = fields[7].strip()
+            if not expire.isdigit():
+                expirations[fields[0]] = None
+                continue
+
+            try:
+                date = datetime(1970, 1, 1) + timedelta(days=int(expire))
+            except (OverflowError, ValueError):
+                # Past year 9999, which datetime cannot hold, so treat it as never expiring
+                expirations[fields[0]] = None
+                continue
+
+            expirations[fields[0]] = date.strftime('%d/%m/%Y')
+
+        return expirations
+
+
+class OpenVPNStatusIndex(FileIndex):
+    PATH = '/etc/openvpn/openvpn-status.log'
+    MMAP_THRESHOLD = 1024 * 1024
+
+    def read(self) -> t.Dict[str, int]:
+        if os.path.getsize(self.path) < self.MMAP_THRESHOLD:
+            return super(OpenVPNStatusIndex, self).read()
+
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                lines = iter(data.readline, b'')
+                return self.parse(line.decode('utf-8', 'replace') for line in lines)
+
+    def parse(self, f: t.Iterable[str]) -> t.Dict[str, int]:
+        clients = {}
+        routes = {}
+
+        section = None
+        columns = {}
+
+        for line in f:
+            line = line.rstrip('\r\n')
+
+            # status-version 3 separates fields with tabs, 1 and 2 with commas
+            fields = line.split('\t') if '\t' in line else line.split(',')
+            tag = fields[0]
+
+            if tag in ('OpenVPN CLIENT LIST', 'ROUTING TABLE', 'GLOBAL STATS'):
+                section, columns = tag, {}
+                continue
+
+            if tag == 'HEADER' and len(fields) > 1:
+                columns[fields[1]] = {name: index for index, name in enumerate(fields[2:], 1)}
+                continue
+
+            if tag == 'CLIENT_LIST':
+                names = [fields[columns.get(tag, {}).get('Common Name', 1)]]
+
+                username_index = columns.get(tag, {}).get('Username')
+                if username_index is not None and username_index < len(fields):
+                    names.append(fields[username_index])
+
+                for name in set(names) - {'UNDEF', ''}:
+                    clients[name] = clients.get(name, 0) + 1
+                continue
+
+            if tag == 'ROUTING_TABLE' and len(fields) > 2:
+                name = fields[columns.get(tag, {}).get('Common Name', 2)]
+                routes[name] = routes.get(name, 0) + 1
+                continue
+
+            if tag in ('END', 'Updated') or section is None or len(fields) < 2:
+                continue
+
+            # status-version 1: sections are introduced by a title and a column header line
+            if tag in ('Common Name', 'Virtual Address'):
+                columns = {name: index for index, name in enumerate(fields)}
+                continue
+
+            if section == 'OpenVPN CLIENT LIST':
+                name = fields[columns.get('Common Name', 0)]
+                clients[name] = clients.get(name, 0) + 1
+            elif section == 'ROUTING TABLE' and len(fields) > 1:
+                name = fields[columns.get('Common Name', 1)]
+                routes[name] = routes.get(name, 0) + 1
+
+        # A client that only shows up in the routing table is still connected
+        for name, count in routes.items():
+            clients.setdefault(name, count)
+
+        return clients
+
+
+class SharedStateIndex(FileIndex):
+    # tmpfs like /dev/shm, but only root can create or read anything inside
+    DIRECTORY = '/run/checker'
+    PATH = os.path.join(DIRECTORY, 'state.json')
+    LOG_LEVEL = logging.DEBUG
+
+    @classmethod
+    def prepare_directory(cls, directory: str = None) -> None:
+        directory = directory or cls.DIRECTORY
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        info = os.lstat(directory)
+        if (
+            not stat.S_ISDIR(info.st_mode)
+            or info.st_uid != os.geteuid()
+            or info.st_mode & 0o077
+        ):
+            raise OSError('%s must be a directory private to uid %d' % (directory, os.geteuid()))
+
+    def read(self) -> t.Dict[str, t.Any]:
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return json.loads(data[:])
+
+    @classmethod
+    def publish(cls, state: t.Dict[str, t.Any], path: str = None) -> None:
+        import tempfile
+
+        path = path or cls.PATH
+
+        # mkstemp creates the file exclusively with mode 0600
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path)
+        )
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class CheckerUserManager:
+    def __init__(self, username: str):
+        self.username = username
+        self.ssh_manager = SSHManager()
+        self.openvpn_manager = OpenVPNManager()
+
+    def get_expiration_date(self) -> t.Optional[str]:
+        return ShadowIndex.get_instance().get(self.username)
+
+    @staticmethod
+    def get_expiration_days(date: str) -> int:
+        if not isinstance(date, str) or date.lower() == 'never' or not isinstance(date, str):
+            return -1
+
+        return (datetime.strptime(date, '%d/%m/%Y') - datetime.now()).days
+
+    def get_connections(self) -> int:
+        return self.ssh_manager.count_connections(
+            self.username
+        ) + self.openvpn_manager.count_connections(self.username)
+
+    def get_time_online(self) -> t.Optional[str]:
+        return self.ssh_manager.get_time_online(self.username)
+
+    def get_limiter_connection(self) -> int:
+        return LimitIndex.get_instance().get(self.username, -1)
+
+    def get_sessions(self) -> t.List[Session]:
+        sessions = [
+            Session('ssh', process.pid, self.username, process.start_time)
+            for process in self.ssh_manager.get_sessions(self.username)
+        ]
+        sessions.extend(self.openvpn_manager.get_sessions(self.username))
+        sessions.sort(key=lambda session: session.started_at)
+        return sessions
+
+    def kill_connection(self, selection: str = 'all') -> int:
+        if selection == 'all':
+            ssh = self.ssh_manager.count_connections(self.username)
+            openvpn = self.openvpn_manager.count_connections(self.username)
+
+            self.ssh_manager.kill_connection(self.username)
+
+            if openvpn > 0 and not self.openvpn_manager.kill_connection(self.username):
+                raise ConnectionError('OpenVPN did not confirm the kill of %s' % self.username)
+
+            return ssh + openvpn
+
+        sessions = select_sessions(self.get_sessions(), selection)
+        return kill_sessions(sessions, self.ssh_manager, self.openvpn_manager)
+
+
+def kill_sessions(
+    sessions: t.Iterable[Session],
+    ssh_manager: SSHManager,
+    openvpn_manager: OpenVPNManager,
+) -> int:
+    killed = 0
+
+    for session in sessions:
+        if session.kind == 'ssh':
+            success = ssh_manager.kill_pid(session.id)
+        else:
+            success = openvpn_manager.kill_client(session.id)
+
+        if success:
+            killed += 1
+            logger.info('Killed %s session %s of %s' % (session.kind, session.id, session.username))
+
+    return killed
+
+
+class SystemSnapshot:
+    def __init__(
+        self,
+        uids: t.Dict[str, int],
+        processes: ProcSnapshot,
+        openvpn_clients: t.Optional[t.Dict[str, t.List[OpenVPNClient]]],
+        openvpn_log_counts: t.Optional[t.Dict[str, int]],
+        expirations: t.Dict[str, t.Optional[str]],
+        limits: t.Dict[str, int],
+    ):
+        self.uids = uids
+        self.processes = processes
+        self.openvpn_clients = openvpn_clients
+        self.openvpn_log_counts = openvpn_log_counts
+        self.expirations = expirations
+        self.limits = limits
+
+    @classmethod
+    def take(cls) -> 'SystemSnapshot':
+        openvpn_manager = OpenVPNManager()
+        openvpn_clients = openvpn_manager.get_table()
+
+        uids = PasswdIndex.get_instance().load()
+
+        tracker = AuthLogTracker.instance
+        if tracker is not None and tracker.is_ready:
+            processes = tracker.snapshot(uids)
+        else:
+            processes = ProcScanner.get_instance().snapshot()
+
+        return cls(
+            uids=uids,
+            processes=processes,
+            openvpn_clients=openvpn_clients,
+            openvpn_log_counts=(
+                openvpn_manager.get_log_counts() if openvpn_clients is None else None
+            ),
+            expirations=ShadowIndex.get_instance().load(),
+            limits=LimitIndex.get_instance().load(),
+        )
+
+    def get_ssh_sessions(self, username: str) -> t.List[ProcessInfo]:
+        uid = self.uids.get(username)
+        return self.processes.get_sessions(uid) if uid is not None else []
+
+    def count_openvpn_connections(self, username: str) -> int:
+        if self.openvpn_clients is not None:
+            return len(self.openvpn_clients.get(username, []))
+
+        return self.openvpn_log_counts.get(username, 0)
+
+    def get_sessions(self, username: str) -> t.List[Session]:
+        sessions = [
+            Session('ssh', process.pid, username, process.start_time)
+            for process in self.get_ssh_sessions(username)
+        ]
+
+        if self.openvpn_clients is not None:
+            sessions.extend(
+                Session('openvpn', client.client_id, username, client.connected_since)
+                for client in self.openvpn_clients.get(username, [])
+                if client.client_id is not None
+            )
+
+        sessions.sort(key=lambda session: session.started_at)
+        return sessions
+
+    def get_active_usernames(self) -> t.Set[str]:
+        usernames = set(self.limits)
+        usernames.update(name for name, date in self.expirations.items() if date is not None)
+
+        names = {uid: name for name, uid in self.uids.items()}
+        usernames.update(names[uid] for uid in self.processes.sessions if uid in names)
+
+        if self.openvpn_clients is not None:
+            usernames.update(self.openvpn_clients)
+
+        return usernames
+
+    def build_table(self) -> t.Mapping[str, t.Dict[str, t.Any]]:
+        return MappingProxyType(
+            {username: self.check_user(username) for username in self.get_active_usernames()}
+        )
+
+    def check_user(self, username: str) -> t.Dict[str, t.Any]:
+        ssh_sessions = self.get_ssh_sessions(username)
+        expiration_date = self.expirations.get(username)
+
+        return {
+            'username': username,
+            'count_connection': len(ssh_sessions) + self.count_openvpn_connections(username),
+            'limit_connection': self.limits.get(username, -1),
+            'expiration_date': expiration_date,
+            'expiration_days': CheckerUserManager.get_expiration_days(expiration_date),
+            'time_online': SSHManager.format_time_online(ssh_sessions),
+            'version': __version__,
+        }
+
+
+class CheckerUserConfig:
+    CONFIG_FILE = 'config.json'
+    PATH_CONFIG = '/etc/checker/'
+    PATH_CONFIG_OPTIONAL = os.path.join(os.path.expanduser('~'), 'checker')
+
+    def __init__(self):
+        self._config = None
+
+    @property
+    def config(self) -> dict:
+        if self._config is None:
+            self._config = self.load_config()
+
+        return self._config
+
+    @config.setter
+    def config(self, value: dict):
+        self._config = value
+
+    @property
+    def path_config(self) -> str:
+        path = os.path.join(self.PATH_CONFIG, self.CONFIG_FILE)
+
+        try:
+            if not os.path.exists(path):
+                os.makedirs(self.PATH_CONFIG, exist_ok=True)
+        except PermissionError:
+            path = os.path.join(self.PATH_CONFIG_OPTIONAL, self.CONFIG_FILE)
+
+            if not os.path.exists(path):
+                os.makedirs(self.PATH_CONFIG_OPTIONAL, exist_ok=True)
+
+        return path
+
+    @property
+    def exclude(self) -> t.List[str]:
+        return self.config.get('exclude', [])
+
+    @exclude.setter
+    def exclude(self, value: t.List[str]):
+        self.config['exclude'] = value
+        self.save_config()
+
+    def include(self, name: str) -> bool:
+        if name in self.exclude:
+            self.exclude.remove(name)
+            self.save_config()
+            return True
+
+        return False
+
+    @property
+    def port(self) -> int:
+        return self.config.get('port', 5000)
+
+    @port.setter
+    def port(self, value: int):
+        self.config['port'] = value
+        self.save_config()
+
+    def load_config(self) -> dict:
+        default_config = {
+            'exclude': [],
+            'port': 5000,
+        }
+
+        if os.path.exists(self.path_config):
+            with open(self.path_config, 'r') as f:
+                data = json.load(f)
+                return data if isinstance(data, dict) else default_config
+
+        return default_config
+
+    def save_config(self, config: dict = None):
+        self.config = config or self.config
+
+        with open(self.path_config, 'w') as f:
+            f.write(json.dumps(self.config, indent=4))
+
+    @staticmethod
+    def remove_config() -> None:
+        if os.path.exists(CheckerUserConfig.PATH_CONFIG):
+            os.system('rm -rf %s' % CheckerUserConfig.PATH_CONFIG)
+
+
+class AuthLogTracker(threading.Thread):
+    LOG_PATH = '/var/log/auth.log'
+    STATE_FILE = 'auth_log_state.json'
+
+    EVENT_PATTERN = re.compile(
+        r'sshd(?:-session)?\[(?P<pid>\d+)\]: (?:'
+        r'Accepted \S+ for (?P<accepted>\S+) from'
+        r'|pam_unix\(sshd:session\): session (?P<event>opened|closed) for user (?P<user>[^\s(]+)'
+        r')'
+    )
+
+    # rsyslog writes either "Oct 17 00:00:00 host" or RFC 3339 "2026-10-17T00:00:00.123+00:00 host"
+    TIMESTAMP_FORMAT = '%Y %b %d %H:%M:%S'
+
+    instance = None
+
+    def __init__(
+        self,
+        path: str = None,
+        interval: float = 1.0,
+        reconcile_interval: float = 60.0,
+        state_path: str = None,
+    ):
+        super(AuthLogTracker, self).__init__()
+        self.daemon = True
+
+        self.path = path or self.LOG_PATH
+        self.interval = interval
+        self.reconcile_interval = reconcile_interval
+        self.state_path = state_path or os.path.join(
+            os.path.dirname(CheckerUserConfig().path_config), self.STATE_FILE
+        )
+
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+        self.inode = None
+        self.offset = 0
+        self.saved_offset = 0
+        self.saved_at = 0.0
+
+        self.events = 0
+        self.drift = 0
+        self.available = None
+        self.is_ready = False
+
+    @classmethod
+    def start_instance(cls, path: str = None) -> 'AuthLogTracker':
+        tracker = cls(path)
+        tracker.load_state()
+        tracker.poll()
+        tracker.reconcile()
+        tracker.start()
+
+        cls.instance = tracker
+        return tracker
+
+    def load_state(self) -> None:
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+
+            self.inode, self.offset = state['inode'], state['offset']
+            self.saved_offset = self.offset
+        except (OSError, ValueError, KeyError, TypeError):
+            self.inode, self.offset = None, 0
+
+    def save_state(self) -> None:
+        if self.offset == self.saved_offset or time.monotonic() - self.saved_at < 10:
+            return
+
+        try:
+            with open(self.state_path, 'w') as f:
+                json.dump({'inode': self.inode, 'offset': self.offset}, f)
+        except OSError as e:
+            logger.debug('Failed to save auth log state: %s' % e)
+            return
+
+        self.saved_offset = self.offset
+        self.saved_at = time.monotonic()
+
+    def open_session(self, username: str, pid: int, started_at: float) -> None:
+        with self.lock:
+            self.sessions.setdefault(username, {}).setdefault(pid, started_at)
+
+    def close_session(self, username: str, pid: int) -> None:
+        with self.lock:
+            sessions = self.sessions.get(username)
+            if sessions is not None:
+                sessions.pop(pid, None)
+                if not sessions:
+                    del self.sessions[username]
+
+    def parse_timestamp(self, line: str) -> float:
+        try:
+            if line[:4].isdigit():
+                return datetime.fromisoformat(line.split(' ', 1)[0]).timestamp()
+
+            now = datetime.now()
+            date = datetime.strptime('%d %s' % (now.year, line[:15]), self.TIMESTAMP_FORMAT)
+
+            # Traditional lines carry no year, so a date ahead of now was written last year
+            if date > now + timedelta(days=1):
+                date = date.replace(year=now.year - 1)
+
+            return date.timestamp()
+        except ValueError:
+            return time.time()
+
+    def process_line(self, line: str) -> None:
+        match = self.EVENT_PATTERN.search(line)
+        if match is None:
+            return
+
+        self.events += 1
+        pid = int(match.group('pid'))
+
+        if match.group('accepted'):
+            self.open_session(match.group('accepted'), pid, self.parse_timestamp(line))
+        elif match.group('event') == 'opened':
+            self.open_session(match.group('user'), pid, self.parse_timestamp(line))
+        else:
+            self.close_session(match.group('user'), pid)
+
+    def poll(self) -> None:
+        try:
+            f = open(self.path, 'rb')
+        except OSError as e:
+            # Without the log every count would go stale, so fall back to /proc until it returns
+            if self.available is not False:
+                logger.warning('Auth log tracker cannot read %s: %s' % (self.path, e))
+            self.available = self.is_ready = False
+            return
+
+        self.available = True
+
+        with f:
+            stat = os.fstat(f.fileno())
+
+            # Rotated or truncated: start again from the top of the new file
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.inode, self.offset = stat.st_ino, 0
+
+            if stat.st_size == self.offset:
+                return
+
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8', 'replace').splitlines():
+            self.process_line(line)
+
+        self.offset += end
+        self.save_state()
+
+    def reconcile(self) -> None:
+        snapshot = ProcScanner.get_instance().snapshot()
+        names = {uid: name for name, uid in PasswdIndex.get_instance().load().items()}
+
+        proc_path = ProcScanner.PROC_PATH
+
+        with self.lock:
+            for username in list(self.sessions):
+                sessions = self.sessions[username]
+                for pid in [
+                    pid for pid in sessions if not os.path.exists(os.path.join(proc_path, str(pid)))
+                ]:
+                    del sessions[pid]
+
+                if not sessions:
+                    del self.sessions[username]
+
+            expected = {
+                names[uid]: processes
+                for uid, processes in snapshot.sessions.items()
+                if uid in names
+            }
+
+            drift = 0
+            for username in set(self.sessions) | set(expected):
+                processes = expected.get(username, [])
+                if len(self.sessions.get(username, {})) == len(processes):
+                    continue
+
+                drift += 1
+                if not processes:
+                    self.sessions.pop(username, None)
+                    continue
+
+                # The log names the privileged monitor, /proc shows its per-user child
+                tracked = self.sessions.get(username, {})
+                sessions = {}
+                for process in processes:
+                    pid = process.ppid if process.ppid not in sessions else process.pid
+                    sessions[pid] = tracked.get(pid, process.start_time)
+
+                self.sessions[username] = sessions
+
+        self.drift += drift
+        self.is_ready = self.available is True
+
+        if drift:
+            logger.info('Auth log tracker corrected %d users against /proc' % drift)
+
+    def count_connections(self, username: str) -> int:
+        return len(self.sessions.get(username, ()))
+
+    def get_sessions(self, username: str, uid: int) -> t.List[ProcessInfo]:
+        with self.lock:
+            sessions = sorted(self.sessions.get(username, {}).items())
+
+        return [ProcessInfo(pid, uid, 'sshd', started_at) for pid, started_at in sessions]
+
+    def snapshot(self, uids: t.Dict[str, int]) -> ProcSnapshot:
+        sessions = {}
+
+        for username in list(self.sessions):
+            uid = uids.get(username)
+            if uid is not None:
+                sessions.setdefault(uid, []).extend(self.get_sessions(username, uid))
+
+        return ProcSnapshot(sessions, time.monotonic())
+
+    def run(self) -> None:
+        reconciled_at = time.monotonic()
+
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                self.poll()
+
+                if time.monotonic() - reconciled_at >= self.reconcile_interval:
+                    self.reconcile()
+                    reconciled_at = time.monotonic()
+            except Exception as e:
+                logger.error('Auth log tracker failed: %s' % e)
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {
+            'path': self.path,
+            'offset': self.offset,
+            'events': self.events,
+            'drift': self.drift,
+            'users': len(self.sessions),
+        }
+
+
+class ServiceManager:
+    CONFIG_SYSTEMD_PATH = '/etc/systemd/system/'
+    CONFIG_SYSTEMD = 'user_check.service'
+
+    @property
+    def config(self) -> str:
+        return os.path.join(self.CONFIG_SYSTEMD_PATH, self.CONFIG_SYSTEMD)
+
+    @property
+    def is_created(self) -> bool:
+        return os.path.exists(self.config)
+
+    @property
+    def is_enabled(self) -> bool:
+        return os.system('systemctl is-enabled %s >/dev/null' % self.CONFIG_SYSTEMD) == 0
+
+    def status(self) -> str:
+        command = 'systemctl status %s' % self.CONFIG_SYSTEMD
+        result = os.popen(command).readlines()
+        return ''.join(result)
+
+    def start(self):
+        status = self.status()
+        if 'Active: active' not in status:
+            os.system('systemctl start %s' % self.CONFIG_SYSTEMD)
+            return True
+
+        logger.info('Service is already running')
+        return False
+
+    def stop(self):
+        status = self.status()
+        if 'Active: inactive' not in status:
+            os.system('systemctl stop %s' % self.CONFIG_SYSTEMD)
+            return True
+
+        logger.info('Service is already stopped')
+        return False
+
+    def restart(self) -> bool:
+        command = 'systemctl restart %s' % self.CONFIG_SYSTEMD
+        return os.system(command) == 0
+
+    def remove_service(self):
+        os.system('systemctl stop %s' % self.CONFIG_SYSTEMD)
+        os.system('systemctl disable %s' % self.CONFIG_SYSTEMD)
+        os.system('rm %s' % self.config)
+        os.system('systemctl daemon-reload')
+
+    def create_systemd_config(self):
+        config_template = ''.join(
+            [
                 '[Unit]\n',
                 'Description=User check service\n',
                 'After=network.target\n\n',
@@ -314,270 +1481,2183 @@ class ServiceManager:
             ]
         )
 
-        config_path = os.path.join(self.CONFIG_SYSTEMD_PATH, self.CONFIG_SYSTEMD)
-        if not os.path.exists(config_path):
-            try:
-                with open(config_path, 'w') as f:
-                    f.write(config_template)
-            except PermissionError:
-                logging.warning('Permission denied to create systemd config')
-                return
+        config_path = os.path.join(self.CONFIG_SYSTEMD_PATH, self.CONFIG_SYSTEMD)
+        if not os.path.exists(config_path):
+            try:
+                with open(config_path, 'w') as f:
+                    f.write(config_template)
+            except PermissionError:
+                logging.warning('Permission denied to create systemd config')
+                return
+
+            os.system('systemctl daemon-reload >/dev/null')
+
+    def enable_auto_start(self) -> bool:
+        if not self.is_enabled:
+            os.system('systemctl enable %s >/dev/null' % self.CONFIG_SYSTEMD)
+
+        return self.is_enabled
+
+    def disable_auto_start(self) -> bool:
+        if self.is_enabled:
+            os.system('systemctl disable %s >/dev/null' % self.CONFIG_SYSTEMD)
+
+        return not self.is_enabled
+
+    def create_service(self) -> bool:
+        self.create_systemd_config()
+        return self.is_created
+
+
+class CheckerManager:
+    RAW_URL_DATA = 'https://raw.githubusercontent.com/NT-GIT-HUB/DataPlugin/main/user_check.py'
+
+    EXECUTABLE_PATH = '/usr/bin/'
+    EXECUTABLE_NAME = 'checker'
+    EXECUTABLE_FILE = EXECUTABLE_PATH + EXECUTABLE_NAME
+
+    # Imports the module instead of running it as a script, so its compiled bytecode is cached
+    LAUNCHER_TEMPLATE = '\n'.join(
+        [
+            '#!%s' % sys.executable,
+            'import sys',
+            'sys.path.insert(0, %r)',
+            'from %s import main',
+            'if __name__ == \'__main__\':',
+            '    main()',
+            '',
+        ]
+    )
+
+    @staticmethod
+    def create_executable() -> None:
+        of_path = os.path.join(os.path.expanduser('~'), 'chk.py')
+        to_path = CheckerManager.EXECUTABLE_FILE
+
+        if os.path.exists(to_path):
+            os.unlink(to_path)
+
+        logger.info('Creating executable file...')
+        logger.info('From: %s' % of_path)
+        logger.info('To: %s' % to_path)
+
+        directory, filename = os.path.split(of_path)
+        module = os.path.splitext(filename)[0]
+
+        try:
+            with open(to_path, 'w') as f:
+                f.write(CheckerManager.LAUNCHER_TEMPLATE % (directory, module))
+
+            os.chmod(to_path, 0o755)
+            logger.info('Done!')
+        except Exception as e:
+            logger.error(e)
+
+    @staticmethod
+    def get_data() -> str:
+        import requests
+
+        response = requests.get(CheckerManager.RAW_URL_DATA)
+        return response.text
+
+    @staticmethod
+    def check_update() -> t.Union[bool, str]:
+        data = CheckerManager.get_data()
+
+        if data:
+            version = data.split('__version__ = ')[1].split('\n')[0].strip('\'')
+            return version != __version__, version
+
+        return False, __version__
+
+    @staticmethod
+    def update() -> bool:
+        success, version = CheckerManager.check_update()
+        if not success:
+            logger.info('No update available')
+            return False
+
+        logger.info('New version available: %s' % version)
+
+        data = CheckerManager.get_data()
+        if not data:
+            return False
+
+        with open(__file__, 'w') as f:
+            f.write(data)
+
+        CheckerManager.create_executable()
+        ServiceManager().restart()
+        return True
+
+    @staticmethod
+    def remove_executable() -> None:
+        os.remove(CheckerManager.EXECUTABLE_FILE)
+
+
+class Histogram:
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets: t.Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self) -> t.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, name: str, labels: str = '') -> t.List[str]:
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        prefix = labels + ',' if labels else ''
+        lines = []
+        cumulative = 0
+
+        for bucket, value in zip(self.buckets + (float('inf'),), counts):
+            cumulative += value
+            le = '+Inf' if bucket == float('inf') else repr(bucket)
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, le, cumulative))
+
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %f' % (name, suffix, total))
+        lines.append('%s_count%s %d' % (name, suffix, count))
+        return lines
+
+
+class Metrics:
+    STAGES = ('ssh_count', 'openvpn_count', 'expiration', 'limit', 'time_online')
+    CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.requests = {}
+        self.request_latency = Histogram()
+        self.stages = {stage: Histogram() for stage in self.STAGES}
+        self.gauges = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls) -> 'Metrics':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+
+        return cls._instance
+
+    def time_stage(self, stage: str) -> t.ContextManager[None]:
+        return self.stages[stage].time()
+
+    def observe_request(self, command: t.Optional[str], elapsed: float) -> None:
+        command = command if command in FunctionExecutor.COMMANDS else 'OTHER'
+
+        with self.lock:
+            self.requests[command] = self.requests.get(command, 0) + 1
+
+        self.request_latency.observe(elapsed)
+
+    def register_gauge(
+        self, name: str, description: str, function: t.Callable[[], float], kind: str = 'gauge'
+    ) -> None:
+        self.gauges[name] = (description, kind, function)
+
+    def render(self) -> str:
+        lines = [
+            '# HELP checker_requests_total Requests handled, by command',
+            '# TYPE checker_requests_total counter',
+        ]
+        lines.extend(
+            'checker_requests_total{command="%s"} %d' % (command, count)
+            for command, count in sorted(self.requests.items())
+        )
+
+        lines.append('# HELP checker_request_duration_seconds Time to answer a request')
+        lines.append('# TYPE checker_request_duration_seconds histogram')
+        lines.extend(self.request_latency.render('checker_request_duration_seconds'))
+
+        lines.append('# HELP checker_stage_duration_seconds Time spent in each check probe')
+        lines.append('# TYPE checker_stage_duration_seconds histogram')
+        for stage, histogram in self.stages.items():
+            lines.extend(histogram.render('checker_stage_duration_seconds', 'stage="%s"' % stage))
+
+        for name, (description, kind, function) in list(self.gauges.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %s' % (name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class PendingResult:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.invalidated = False
+
+
+class ResultCache:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, ttl: float = 1.0, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @classmethod
+    def get_instance(cls) -> 'ResultCache':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+
+        return cls._instance
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    def get_or_compute(
+        self, key: str, compute: t.Callable[[], t.Dict[str, t.Any]]
+    ) -> t.Dict[str, t.Any]:
+        if not self.enabled:
+            return compute()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            pending = self.pending.get(key)
+            is_owner = pending is None
+
+            if is_owner:
+                pending = self.pending[key] = PendingResult()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_owner:
+            pending.event.wait()
+            return pending.value
+
+        try:
+            pending.value = compute()
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+                if not pending.invalidated and pending.value and 'error' not in pending.value:
+                    self.entries[key] = (time.monotonic() + self.ttl, pending.value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_size:
+                        self.entries.popitem(last=False)
+
+            pending.event.set()
+
+        return pending.value
+
+    def invalidate(self, key: str) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+            pending = self.pending.get(key)
+            if pending is not None:
+                pending.invalidated = True
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses + self.coalesced
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+    def register_metrics(self, metrics: Metrics) -> None:
+        metrics.register_gauge(
+            'checker_cache_hits_total', 'Result cache hits', lambda: self.hits, 'counter'
+        )
+        metrics.register_gauge(
+            'checker_cache_misses_total', 'Result cache misses', lambda: self.misses, 'counter'
+        )
+        metrics.register_gauge(
+            'checker_cache_coalesced_total',
+            'Requests that waited for an in-flight check',
+            lambda: self.coalesced,
+            'counter',
+        )
+        metrics.register_gauge(
+            'checker_cache_hit_rate',
+            'Share of checks served without a probe',
+            lambda: self.hit_rate,
+        )
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {
+            'ttl': self.ttl,
+            'max_size': self.max_size,
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+
+def check_user(username: str) -> t.Dict[str, t.Any]:
+    try:
+        checker = CheckerUserManager(username)
+        metrics = Metrics.get_instance()
+
+        with metrics.time_stage('ssh_count'):
+            count = checker.ssh_manager.count_connections(username)
+
+        with metrics.time_stage('openvpn_count'):
+            count += checker.openvpn_manager.count_connections(username)
+
+        with metrics.time_stage('expiration'):
+            expiration_date = checker.get_expiration_date()
+            expiration_days = checker.get_expiration_days(expiration_date)
+
+        with metrics.time_stage('limit'):
+            limit_connection = checker.get_limiter_connection()
+
+        with metrics.time_stage('time_online'):
+            time_online = checker.get_time_online()
+
+        return {
+            'username': username,
+            'count_connection': count,
+            'limit_connection': limit_connection,
+            'expiration_date': expiration_date,
+            'expiration_days': expiration_days,
+            'time_online': time_online,
+            'version': __version__,
+        }
+    except Exception as e:
+        return {'error': str(e)}
+
+
+class StateCollector(threading.Thread):
+    instance = None
+
+    def __init__(self, interval: float = 5.0, publish_path: str = None):
+        super(StateCollector, self).__init__()
+        self.daemon = True
+
+        self.interval = interval
+        self.publish_path = publish_path
+
+        self.table = MappingProxyType({})
+        self.openvpn_clients = None
+        self.updated_at = 0.0
+        self.cycle_time = 0.0
+        self.invalidated = set()
+
+    @classmethod
+    def start_instance(cls, interval: float, publish_path: str = None) -> 'StateCollector':
+        collector = cls(interval, publish_path)
+        collector.collect()
+        collector.start()
+
+        StateCollector.instance = collector
+        return collector
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.updated_at < self.interval * 3
+
+    def get(self, username: str) -> t.Optional[t.Dict[str, t.Any]]:
+        if not self.is_fresh or username in self.invalidated:
+            return None
+
+        return self.table.get(username)
+
+    def invalidate(self, username: str) -> None:
+        self.invalidated.add(username)
+
+    def collect(self) -> None:
+        start = time.perf_counter()
+
+        snapshot = SystemSnapshot.take()
+        table = snapshot.build_table()
+
+        self.table, self.invalidated = table, set()
+        self.openvpn_clients = snapshot.openvpn_clients
+        self.updated_at = time.monotonic()
+
+        if self.publish_path:
+            state = {
+                'created_at': time.time(),
+                'users': dict(table),
+                'openvpn': snapshot.openvpn_clients,
+            }
+            SharedStateIndex.publish(state, self.publish_path)
+
+        self.cycle_time = time.perf_counter() - start
+
+        logger.info('Collected %d users in %.2fms' % (len(table), self.cycle_time * 1000))
+
+    def run(self) -> None:
+        while True:
+            time.sleep(max(self.interval - self.cycle_time, 0))
+
+            try:
+                self.collect()
+            except Exception as e:
+                logger.error('Collector failed: %s' % e)
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {
+            'interval': self.interval,
+            'users': len(self.table),
+            'cycle_time': self.cycle_time,
+            'age': time.monotonic() - self.updated_at,
+        }
+
+
+class SharedStateReader(StateCollector):
+    def __init__(self, interval: float = 1.0, path: str = None):
+        super(SharedStateReader, self).__init__(interval)
+        self.index = SharedStateIndex.get_instance(path)
+        self.created_at = 0.0
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.time() - self.created_at < self.interval * 3
+
+    def collect(self) -> None:
+        start = time.perf_counter()
+
+        state = self.index.load()
+        created_at = state.get('created_at', 0.0)
+
+        if created_at != self.created_at:
+            openvpn = state.get('openvpn')
+
+            self.table = MappingProxyType(state.get('users', {}))
+            self.openvpn_clients = (
+                {
+                    name: [OpenVPNClient(*client) for client in clients]
+                    for name, clients in openvpn.items()
+                }
+                if openvpn is not None
+                else None
+            )
+            self.invalidated = set()
+            self.created_at = created_at
+            self.updated_at = time.monotonic()
+
+        self.cycle_time = time.perf_counter() - start
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        stats = super(SharedStateReader, self).stats()
+        stats['age'] = time.time() - self.created_at
+        stats['path'] = self.index.path
+        return stats
+
+
+def check_user_cached(username: str) -> t.Dict[str, t.Any]:
+    collector = StateCollector.instance
+    result = collector.get(username) if collector is not None else None
+    if result is not None:
+        return result
+
+    return ResultCache.get_instance().get_or_compute(username, lambda: check_user(username))
+
+
+def check_users(usernames: t.Iterable[str]) -> t.Iterator[t.Dict[str, t.Any]]:
+    collector = StateCollector.instance
+    snapshot = None
+
+    for username in usernames:
+        try:
+            result = collector.get(username) if collector is not None else None
+            if result is None:
+                snapshot = snapshot or SystemSnapshot.take()
+                result = snapshot.check_user(username)
+        except Exception as e:
+            result = {'username': username, 'error': str(e)}
+
+        yield result
+
+
+def invalidate_user(username: str) -> None:
+    ResultCache.get_instance().invalidate(username)
+
+    if StateCollector.instance is not None:
+        StateCollector.instance.invalidate(username)
+
+
+class LimitEnforcer(threading.Thread):
+    instance = None
+
+    def __init__(self, interval: float = 5.0):
+        super(LimitEnforcer, self).__init__()
+        self.daemon = True
+
+        self.interval = interval
+        self.ssh_manager = SSHManager()
+        self.openvpn_manager = OpenVPNManager()
+
+        self.ticks = 0
+        self.killed = 0
+        self.tick_time = 0.0
+
+    @classmethod
+    def start_instance(cls, interval: float) -> 'LimitEnforcer':
+        enforcer = cls.instance = cls(interval)
+        enforcer.start()
+        return enforcer
+
+    def enforce(self, snapshot: SystemSnapshot) -> int:
+        killed = 0
+
+        for username, limit in snapshot.limits.items():
+            if limit < 1:
+                continue
+
+            sessions = snapshot.get_sessions(username)
+            if len(sessions) <= limit:
+                continue
+
+            excess = select_sessions(sessions, 'newest:%d' % (len(sessions) - limit))
+            killed += kill_sessions(excess, self.ssh_manager, self.openvpn_manager)
+            invalidate_user(username)
+
+        return killed
+
+    def tick(self) -> None:
+        start = time.perf_counter()
+
+        killed = self.enforce(SystemSnapshot.take())
+
+        self.ticks += 1
+        self.killed += killed
+        self.tick_time = time.perf_counter() - start
+
+        logger.info('Enforcer tick: %.2fms, %d sessions killed' % (self.tick_time * 1000, killed))
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error('Enforcer failed: %s' % e)
+
+            time.sleep(max(self.interval - self.tick_time, 0))
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {
+            'interval': self.interval,
+            'ticks': self.ticks,
+            'killed': self.killed,
+            'tick_time': self.tick_time,
+        }
+
+
+def kill_user(username: str, selection: str = 'all') -> dict:
+    result = {
+        'success': True,
+        'error': None,
+        'killed': 0,
+    }
+
+    try:
+        if ProcessSupervisor.control_path is not None:
+            # Worker processes hand kills to the supervisor, which owns the management port
+            result = query_unix_socket(
+                ProcessSupervisor.control_path,
+                'KILL',
+                username,
+                selection,
+                ProcessSupervisor.CONTROL_TIMEOUT,
+            )
+        else:
+            checker = CheckerUserManager(username)
+            result['killed'] = checker.kill_connection(selection)
+
+        invalidate_user(username)
+        return result
+    except Exception as e:
+        result['success'] = False
+        result['error'] = str(e)
+        return result
+
+
+def query_daemon(
+    port: int,
+    command: str,
+    username: str,
+    selection: str = 'all',
+    timeout: float = 2.0,
+) -> t.Dict[str, t.Any]:
+    from urllib.parse import quote
+
+    path = '/%s/%s' % (command.lower(), quote(username))
+    if selection != 'all':
+        path += '?select=%s' % quote(selection)
+
+    with socket.create_connection(('127.0.0.1', port), timeout) as sock:
+        sock.sendall(b'GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n' % path.encode())
+
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+
+    _, _, body = b''.join(chunks).partition(b'\r\n\r\n')
+    return json.loads(body)
+
+
+def query_unix_socket(
+    path: str,
+    command: str,
+    username: str,
+    selection: str = 'all',
+    timeout: float = 2.0,
+) -> t.Dict[str, t.Any]:
+    request = {'command': command, 'username': username, 'select': selection}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+
+        UnixSocketServer.send_frame(sock, json.dumps(request).encode('utf-8'))
+        payload = UnixSocketServer.recv_frame(sock)
+
+    if payload is None:
+        raise ConnectionError('Server closed the connection')
+
+    return json.loads(payload)
+
+
+class RequestError(ValueError):
+    def __init__(self, status: int, message: str):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+class ParserServerRequest:
+    def __init__(self, data: bytes = b''):
+        self.data = data
+        self.method = None
+        self.path = None
+        self.command = None
+        self.content = None
+        self.query = {}
+        self.body = None
+        self.version = 'HTTP/1.1'
+        self.headers = {}
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+
+        return connection != 'close'
+
+    @property
+    def content_length(self) -> int:
+        value = self.headers.get('content-length', '0')
+        if not value.isdigit():
+            raise RequestError(400, 'Invalid Content-Length')
+
+        return int(value)
+
+    @property
+    def selection(self) -> str:
+        return self.query.get('select', ['all'])[0]
+
+    @property
+    def accept(self) -> str:
+        return self.headers.get('accept', '')
+
+    @property
+    def users(self) -> t.Optional[t.List[str]]:
+        if self.query.get('users'):
+            return [user for value in self.query['users'] for user in value.split(',') if user]
+
+        if self.body:
+            try:
+                users = json.loads(self.body)
+            except ValueError:
+                return None
+
+            if isinstance(users, dict):
+                users = users.get('users')
+
+            if isinstance(users, list):
+                return [str(user) for user in users]
+
+        return None
+
+    def parse_head(self, head: bytes) -> None:
+        lines = head.decode('latin-1').split('\r\n')
+
+        request_line = lines[0].split(' ')
+        if len(request_line) != 3 or not request_line[1].startswith('/'):
+            raise RequestError(400, 'Malformed request line')
+
+        self.method, target, version = request_line
+        self.version = version.upper()
+
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if not separator:
+                raise RequestError(400, 'Malformed header line')
+
+            self.headers[name.strip().lower()] = value.strip()
+
+        from urllib.parse import parse_qs, unquote
+
+        self.path, _, query = target.partition('?')
+        segments = self.path.split('/', 3)
+
+        self.command = unquote(segments[1]).upper() if segments[1] else None
+        self.content = unquote(segments[2]) if len(segments) > 2 and segments[2] else None
+        self.query = parse_qs(query) if query else {}
+
+    def validate(self) -> None:
+        if self.command == 'KILL' and not self.content:
+            raise RequestError(400, 'Missing username')
+
+        if self.command == 'CHECK' and not self.content and self.users is None:
+            raise RequestError(400, 'Missing username')
+
+    def parse(self) -> None:
+        try:
+            head, _, body = self.data.partition(b'\r\n\r\n')
+            self.parse_head(head)
+            self.body = body.decode('utf-8')
+
+        except (RequestError, UnicodeDecodeError):
+            self.command = None
+            self.content = None
+
+
+class RequestStreamParser:
+    MAX_HEADER_SIZE = 8192
+    MAX_BODY_SIZE = 8192 * 8
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.request = None
+        self.body_length = 0
+        self.scan_offset = 0
+
+    def parse_head(self) -> bool:
+        # Tolerate the empty lines some clients send between pipelined requests
+        while self.buffer[:2] == b'\r\n':
+            del self.buffer[:2]
+
+        index = self.buffer.find(b'\r\n\r\n', self.scan_offset)
+        if index < 0:
+            if len(self.buffer) > self.MAX_HEADER_SIZE:
+                raise RequestError(431, 'Request headers too large')
+
+            self.scan_offset = max(len(self.buffer) - 3, 0)
+            return False
+
+        if index > self.MAX_HEADER_SIZE:
+            raise RequestError(431, 'Request headers too large')
+
+        request = ParserServerRequest()
+        request.parse_head(bytes(self.buffer[:index]))
+
+        if 'transfer-encoding' in request.headers:
+            raise RequestError(501, 'Transfer-Encoding is not supported')
+
+        self.body_length = request.content_length
+        if self.body_length > self.MAX_BODY_SIZE:
+            raise RequestError(413, 'Request body too large')
+
+        del self.buffer[: index + 4]
+        self.scan_offset = 0
+        self.request = request
+        return True
+
+    def feed(self, data: bytes) -> t.List[ParserServerRequest]:
+        self.buffer += data
+        requests = []
+
+        while True:
+            if self.request is None and not self.parse_head():
+                break
+
+            length = self.body_length
+            if len(self.buffer) < length:
+                break
+
+            if length:
+                self.request.body = bytes(self.buffer[:length]).decode('utf-8', 'replace')
+                del self.buffer[:length]
+
+            self.request.validate()
+            requests.append(self.request)
+            self.request = None
+
+        return requests
+
+
+class FunctionExecutor:
+    def __init__(
+        self,
+        command: str,
+        content: str,
+        users: t.List[str] = None,
+        selection: str = 'all',
+    ):
+        self.command = command.upper() if command else None
+        self.content = content
+        self.users = users
+        self.selection = selection
+
+    def check(self) -> t.Union[t.Dict[str, t.Any], t.Iterator[t.Dict[str, t.Any]]]:
+        if self.users is not None:
+            return check_users(self.users)
+
+        return check_user_cached(self.content)
+
+    def kill(self) -> t.Dict[str, t.Any]:
+        return kill_user(self.content, self.selection)
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        collector = StateCollector.instance
+        enforcer = LimitEnforcer.instance
+        tracker = AuthLogTracker.instance
+
+        return {
+            'cache': ResultCache.get_instance().stats(),
+            'collector': collector.stats() if collector is not None else None,
+            'enforcer': enforcer.stats() if enforcer is not None else None,
+            'tracker': tracker.stats() if tracker is not None else None,
+            'limits': LimitIndex.get_instance().stats(),
+            'shadow': ShadowIndex.get_instance().stats(),
+        }
+
+    def metrics(self) -> str:
+        return Metrics.get_instance().render()
+
+    COMMANDS = {
+        'CHECK': check,
+        'KILL': kill,
+        'STATS': stats,
+        'METRICS': metrics,
+    }
+
+    def execute(self) -> t.Union[t.Dict[str, t.Any], str, t.Iterator[dict]]:
+        function = self.COMMANDS.get(self.command)
+        if function is None:
+            return {'error': 'Command not allowed'}
+
+        return function(self)
+
+
+class ResponseEncoder:
+    JSON = 'application/json'
+    MSGPACK = 'application/msgpack'
+    STRUCT = 'application/x-checker-struct'
+
+    MEDIA_TYPES = {
+        'application/json': JSON,
+        'application/msgpack': MSGPACK,
+        'application/x-msgpack': MSGPACK,
+        STRUCT: STRUCT,
+    }
+
+    # status, count_connection, limit_connection, expiration_days, then the STRINGS
+    # fields as a length byte and UTF-8 text, where a length of 255 means null
+    RECORD = struct.Struct('!Biii')
+    STRINGS = ('username', 'expiration_date', 'time_online', 'version', 'error')
+    NULL = 255
+
+    instance = None
+
+    def __init__(self):
+        self.keys = {
+            key: self.pack_str(key)
+            for key in (
+                'username',
+                'count_connection',
+                'limit_connection',
+                'expiration_date',
+                'expiration_days',
+                'time_online',
+                'version',
+                'error',
+            )
+        }
+        self.strings = {__version__: self.pack_str(__version__)}
+        self.records = {__version__: bytes((len(__version__),)) + __version__.encode('utf-8')}
+
+        try:
+            import msgpack
+
+            self.packb = msgpack.packb
+        except ImportError:
+            self.packb = self.pack
+
+    @classmethod
+    def get_instance(cls) -> 'ResponseEncoder':
+        if cls.instance is None:
+            cls.instance = cls()
+
+        return cls.instance
+
+    def negotiate(self, accept: str, command: str = 'CHECK') -> str:
+        for media_type in accept.split(','):
+            content_type = self.MEDIA_TYPES.get(media_type.split(';', 1)[0].strip().lower())
+
+            # The struct layout only describes check results
+            if content_type == self.STRUCT and command != 'CHECK':
+                continue
+
+            if content_type is not None:
+                return content_type
+
+        return self.JSON
+
+    @staticmethod
+    def pack_str(value: str) -> bytes:
+        data = value.encode('utf-8')
+        size = len(data)
+
+        if size < 32:
+            return bytes((0xA0 | size,)) + data
+        if size < 0x100:
+            return b'\xd9' + bytes((size,)) + data
+        if size < 0x10000:
+            return b'\xda' + size.to_bytes(2, 'big') + data
+
+        return b'\xdb' + size.to_bytes(4, 'big') + data
+
+    @staticmethod
+    def pack_int(value: int) -> bytes:
+        if 0 <= value < 0x80:
+            return bytes((value,))
+        if -32 <= value < 0:
+            return bytes((value & 0xFF,))
+        if -0x80000000 <= value < 0x80000000:
+            return b'\xd2' + value.to_bytes(4, 'big', signed=True)
+
+        return b'\xd3' + value.to_bytes(8, 'big', signed=True)
+
+    @staticmethod
+    def pack_header(size: int, fix: int, prefix16: bytes, prefix32: bytes) -> bytes:
+        if size < 16:
+            return bytes((fix | size,))
+        if size < 0x10000:
+            return prefix16 + size.to_bytes(2, 'big')
+
+        return prefix32 + size.to_bytes(4, 'big')
+
+    def pack(self, value: t.Any) -> bytes:
+        kind = type(value)
+
+        if kind is str:
+            packed = self.strings.get(value)
+            return packed if packed is not None else self.pack_str(value)
+        if kind is int:
+            return self.pack_int(value)
+        if value is None:
+            return b'\xc0'
+        if kind is bool:
+            return b'\xc3' if value else b'\xc2'
+        if kind is float:
+            return b'\xcb' + struct.pack('!d', value)
+        if isinstance(value, (list, tuple)):
+            header = self.pack_header(len(value), 0x90, b'\xdc', b'\xdd')
+            return header + b''.join(self.pack(item) for item in value)
+        if isinstance(value, t.Mapping):
+            return self.pack_map(value)
+
+        raise TypeError('Cannot encode %s as msgpack' % kind.__name__)
+
+    def pack_map(self, value: t.Mapping[str, t.Any]) -> bytes:
+        parts = [self.pack_header(len(value), 0x80, b'\xde', b'\xdf')]
+        append = parts.append
+        keys, strings = self.keys, self.strings
+
+        # Inline the short strings and small ints that make up a check result
+        for key, item in value.items():
+            append(keys.get(key) or self.pack(key))
+
+            kind = type(item)
+            if kind is str:
+                packed = strings.get(item)
+                if packed is None:
+                    data = item.encode('utf-8')
+                    if len(data) < 32:
+                        packed = bytes((0xA0 | len(data),)) + data
+                    else:
+                        packed = self.pack_str(item)
+                append(packed)
+            elif kind is int and 0 <= item < 0x80:
+                append(bytes((item,)))
+            else:
+                append(self.pack(item))
+
+        return b''.join(parts)
+
+    def pack_record(self, result: t.Mapping[str, t.Any]) -> bytes:
+        get = result.get
+        parts = [
+            self.RECORD.pack(
+                1 if 'error' in result else 0,
+                get('count_connection', -1),
+                get('limit_connection', -1),
+                get('expiration_days', -1),
+            )
+        ]
+        append = parts.append
+        records = self.records
+
+        for name in self.STRINGS:
+            value = get(name)
+            if value is None:
+                append(b'\xff')
+                continue
+
+            packed = records.get(value)
+            if packed is None:
+                data = str(value).encode('utf-8')
+                if len(data) >= self.NULL:
+                    # Cut on a character boundary so decoders never see half a UTF-8 sequence
+                    data = data[: self.NULL - 1].decode('utf-8', 'ignore').encode('utf-8')
+                packed = bytes((len(data),)) + data
+            append(packed)
+
+        return b''.join(parts)
+
+    def encode(self, result: t.Mapping[str, t.Any], content_type: str) -> bytes:
+        if content_type == self.MSGPACK:
+            return self.packb(result)
+        if content_type == self.STRUCT:
+            return self.pack_record(result)
+
+        return json.dumps(result).encode('utf-8')
+
+    def iter_encode(
+        self,
+        results: t.Iterator[t.Mapping[str, t.Any]],
+        content_type: str,
+        count: int,
+    ) -> t.Iterator[bytes]:
+        if content_type == self.MSGPACK:
+            yield self.pack_header(count, 0x90, b'\xdc', b'\xdd')
+            yield from map(self.packb, results)
+            return
+
+        if content_type == self.STRUCT:
+            yield count.to_bytes(4, 'big')
+            yield from map(self.pack_record, results)
+            return
+
+        yield b'['
+        for index, result in enumerate(results):
+            yield (b',' if index else b'') + json.dumps(result).encode('utf-8')
+        yield b']'
+
+
+HTTP_STATUS = {
+    200: 'OK',
+    400: 'Bad Request',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    501: 'Not Implemented',
+}
+
+
+def build_response(
+    body: bytes,
+    keep_alive: bool = False,
+    status: int = 200,
+    content_type: str = 'application/json',
+) -> bytes:
+    return b''.join(
+        [
+            b'HTTP/1.1 %d %s\r\n' % (status, HTTP_STATUS[status].encode()),
+            b'Content-Type: %s\r\n' % content_type.encode(),
+            b'Content-Length: %d\r\n' % len(body),
+            b'Connection: %s\r\n\r\n' % (b'keep-alive' if keep_alive else b'close'),
+            body,
+        ]
+    )
+
+
+def build_error_response(error: RequestError) -> bytes:
+    return build_response(json.dumps({'error': str(error)}).encode('utf-8'), False, error.status)
+
+
+def build_chunked_header(
+    keep_alive: bool = False, content_type: str = 'application/json'
+) -> bytes:
+    return b''.join(
+        [
+            b'HTTP/1.1 200 OK\r\n',
+            b'Content-Type: %s\r\n' % content_type.encode(),
+            b'Transfer-Encoding: chunked\r\n',
+            b'Connection: %s\r\n\r\n' % (b'keep-alive' if keep_alive else b'close'),
+        ]
+    )
+
+
+def iter_chunked(chunks: t.Iterator[bytes], size: int = 16384) -> t.Iterator[bytes]:
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield b'%x\r\n%s\r\n' % (len(buffer), buffer)
+            buffer.clear()
+
+    if buffer:
+        yield b'%x\r\n%s\r\n' % (len(buffer), buffer)
+
+    yield b'0\r\n\r\n'
+
+
+def iter_response(
+    request: ParserServerRequest,
+    result: t.Union[t.Dict[str, t.Any], str, t.Iterator[dict]],
+    size: int = 16384,
+) -> t.Iterator[bytes]:
+    if isinstance(result, str):
+        yield build_response(result.encode('utf-8'), request.keep_alive, 200, Metrics.CONTENT_TYPE)
+        return
+
+    encoder = ResponseEncoder.get_instance()
+    content_type = encoder.negotiate(request.accept, request.command)
+
+    if isinstance(result, dict):
+        body = encoder.encode(result, content_type)
+        yield build_response(body, request.keep_alive, 200, content_type)
+        return
+
+    frames = encoder.iter_encode(result, content_type, len(request.users))
+
+    # HTTP/1.0 clients do not understand chunked transfer-encoding
+    if request.version == 'HTTP/1.0':
+        yield build_response(b''.join(frames), request.keep_alive, 200, content_type)
+        return
+
+    yield build_chunked_header(request.keep_alive, content_type)
+    yield from iter_chunked(frames, size)
+
+
+def process_request(
+    request: ParserServerRequest,
+) -> t.Union[t.Dict[str, t.Any], str, t.Iterator[dict]]:
+    function_executor = FunctionExecutor(
+        request.command,
+        request.content,
+        request.users,
+        request.selection,
+    )
+    return function_executor.execute()
+
+
+class ClientConnection:
+    def __init__(self, sock: socket.socket, addr: t.Tuple[str, int]):
+        self.sock = sock
+        self.addr = addr
+        self.parser = RequestStreamParser()
+        self.last_active = time.monotonic()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class WorkerThread(threading.Thread):
+    CHUNK_SIZE = 16384
+
+    def __init__(
+        self,
+        queue: queue.Queue,
+        park: t.Optional[t.Callable[[ClientConnection], None]] = None,
+    ):
+        super(WorkerThread, self).__init__()
+        self.queue = queue
+        self.park = park
+        self.daemon = True
+
+        self.is_running = False
+        self.is_busy = False
+
+    def parse_request(
+        self, request: ParserServerRequest
+    ) -> t.Union[t.Dict[str, t.Any], str, t.Iterator[dict]]:
+        return process_request(request)
+
+    def handle(self, connection: ClientConnection) -> bool:
+        data = connection.sock.recv(8192 * 8)
+        if not data:
+            return False
+
+        try:
+            requests = connection.parser.feed(data)
+        except RequestError as e:
+            connection.sock.sendall(build_error_response(e))
+            return False
+
+        for request in requests:
+            start = time.perf_counter()
+
+            result = self.parse_request(request)
+            for frame in iter_response(request, result, self.CHUNK_SIZE):
+                connection.sock.sendall(frame)
+
+            Metrics.get_instance().observe_request(request.command, time.perf_counter() - start)
+
+            if not request.keep_alive:
+                return False
+
+        return True
+
+    def run(self):
+        self.is_running = True
+        while self.is_running:
+            connection = self.queue.get()
+            self.is_busy = True
+
+            try:
+                keep_alive = self.handle(connection)
+            except Exception as e:
+                logger.error(e)
+                keep_alive = False
+            finally:
+                self.is_busy = False
+
+            if keep_alive and self.park is not None:
+                self.park(connection)
+                continue
+
+            connection.close()
+            logger.info('Client disconnected: %s' % (connection.addr,))
+
+    def stop(self):
+        self.is_running = False
+
+
+class ThreadPool:
+    def __init__(
+        self,
+        max_workers: int = 10,
+        park: t.Optional[t.Callable[[ClientConnection], None]] = None,
+    ):
+        self.queue = queue.Queue()
+        self.workers = []
+        self.max_workers = max_workers
+        self.park = park
+
+    def start(self):
+        for _ in range(self.max_workers):
+            worker = WorkerThread(self.queue, self.park)
+            worker.start()
+            self.workers.append(worker)
+
+    def join(self):
+        for worker in self.workers:
+            worker.stop()
+            worker.join()
+
+    def add_task(self, connection: ClientConnection):
+        self.queue.put(connection)
+
+    @property
+    def busy_workers(self) -> int:
+        return sum(1 for worker in self.workers if worker.is_busy)
+
+    def register_metrics(self, metrics: Metrics) -> None:
+        metrics.register_gauge(
+            'checker_queue_depth', 'Connections waiting for a worker', self.queue.qsize
+        )
+        metrics.register_gauge('checker_workers_total', 'Worker threads', lambda: self.max_workers)
+        metrics.register_gauge(
+            'checker_workers_busy', 'Worker threads handling a request', lambda: self.busy_workers
+        )
+
+
+class Server:
+    IDLE_TIMEOUT = 30
+    IDLE_SWEEP_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        num_workers: int = 10,
+        backlog: int = 128,
+        reuse_port: bool = False,
+    ):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # Every worker process binds its own socket and the kernel balances accepts between them
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # Idle keep-alive connections wait in the selector instead of holding a worker
+        self.selector = selectors.DefaultSelector()
+        self.parked = queue.Queue()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+
+        self.pool = ThreadPool(num_workers, self.park)
+        self.pool.start()
+        self.pool.register_metrics(Metrics.get_instance())
+
+    def park(self, connection: ClientConnection) -> None:
+        self.parked.put(connection)
+        self.wakeup_writer.send(b'\0')
+
+    def register(self, connection: ClientConnection) -> None:
+        connection.last_active = time.monotonic()
+        self.selector.register(connection, selectors.EVENT_READ, connection)
+
+    def handle(self, client, addr) -> None:
+        logger.info('Client connected: %s' % (addr,))
+        self.register(ClientConnection(client, addr))
+
+    def close_idle(self) -> None:
+        deadline = time.monotonic() - self.IDLE_TIMEOUT
+
+        for key in list(self.selector.get_map().values()):
+            connection = key.data
+            if connection is not None and connection.last_active < deadline:
+                self.selector.unregister(connection)
+                connection.close()
+                logger.info('Client disconnected: %s' % (connection.addr,))
+
+    def process_events(self) -> None:
+        for key, _ in self.selector.select(timeout=1):
+            if key.fileobj is self.socket:
+                client, addr = self.socket.accept()
+                self.handle(client, addr)
+
+            elif key.fileobj is self.wakeup_reader:
+                self.wakeup_reader.recv(4096)
+                while not self.parked.empty():
+                    self.register(self.parked.get())
+
+            else:
+                self.selector.unregister(key.fileobj)
+                self.pool.add_task(key.data)
+
+    def run(self) -> None:
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(self.backlog)
+
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+        logger.info('Server started on %s:%s' % (self.host, self.port))
+
+        swept_at = time.monotonic()
+
+        try:
+            while True:
+                self.process_events()
+
+                # The sweep walks every parked connection, so a busy loop only runs it once a second
+                if time.monotonic() - swept_at >= self.IDLE_SWEEP_INTERVAL:
+                    self.close_idle()
+                    swept_at = time.monotonic()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.socket.close()
+            logger.info('Server stopped')
+
+
+class AsyncServer:
+    IDLE_TIMEOUT = 30
+    CHUNK_SIZE = 16384
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        num_workers: int = 10,
+        backlog: int = 128,
+        reuse_port: bool = False,
+    ):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+        self.pending = 0
+        self.running = 0
+        self.running_lock = threading.Lock()
+        self.register_metrics(Metrics.get_instance())
+
+    def register_metrics(self, metrics: Metrics) -> None:
+        metrics.register_gauge(
+            'checker_queue_depth',
+            'Blocking calls waiting for an executor thread',
+            lambda: self.pending - self.running,
+        )
+        metrics.register_gauge(
+            'checker_workers_total', 'Executor threads', lambda: self.num_workers
+        )
+        metrics.register_gauge(
+            'checker_workers_busy', 'Executor threads running a blocking call', lambda: self.running
+        )
+
+    def call_blocking(self, func: t.Callable, *args) -> t.Any:
+        # Runs on executor threads, where += is not atomic
+        with self.running_lock:
+            self.running += 1
+
+        try:
+            return func(*args)
+        finally:
+            with self.running_lock:
+                self.running -= 1
+
+    async def run_blocking(self, func: t.Callable, *args) -> t.Any:
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self.executor, self.call_blocking, func, *args)
+        finally:
+            self.pending -= 1
+
+    @staticmethod
+    def next_frames(frames: t.Iterator[bytes], size: int) -> bytes:
+        data = b''
+        for frame in frames:
+            data += frame
+            if len(data) >= size:
+                break
+
+        return data
+
+    async def send_response(
+        self,
+        writer: 'asyncio.StreamWriter',
+        request: ParserServerRequest,
+        result: t.Union[t.Dict[str, t.Any], str, t.Iterator[dict]],
+    ) -> None:
+        frames = iter_response(request, result, self.CHUNK_SIZE)
+
+        if isinstance(result, (dict, str)):
+            writer.writelines(frames)
+            await writer.drain()
+            return
+
+        while True:
+            data = await self.run_blocking(self.next_frames, frames, self.CHUNK_SIZE)
+            if not data:
+                break
+
+            writer.write(data)
+            await writer.drain()
+
+    async def handle(
+        self, reader: 'asyncio.StreamReader', writer: 'asyncio.StreamWriter'
+    ) -> None:
+        import asyncio
+
+        addr = writer.get_extra_info('peername')
+        logger.info('Client connected: %s' % (addr,))
+
+        parser = RequestStreamParser()
+        keep_alive = True
+
+        try:
+            while keep_alive:
+                data = await asyncio.wait_for(reader.read(8192 * 8), self.IDLE_TIMEOUT)
+                if not data:
+                    break
+
+                for request in parser.feed(data):
+                    start = time.perf_counter()
+
+                    result = await self.run_blocking(process_request, request)
+                    await self.send_response(writer, request, result)
+
+                    Metrics.get_instance().observe_request(
+                        request.command, time.perf_counter() - start
+                    )
+
+                    keep_alive = request.keep_alive
+                    if not keep_alive:
+                        break
+
+        except RequestError as e:
+            writer.write(build_error_response(e))
+            await writer.drain()
+
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+        except Exception as e:
+            logger.error(e)
+
+        finally:
+            writer.close()
+            logger.info('Client disconnected: %s' % (addr,))
+
+    async def serve(self) -> None:
+        import asyncio
+
+        server = await asyncio.start_server(
+            self.handle,
+            self.host,
+            self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+            reuse_port=self.reuse_port or None,
+        )
+
+        logger.info('Async server started on %s:%s' % (self.host, self.port))
+
+        async with server:
+            await server.serve_forever()
+
+    def run(self) -> None:
+        import asyncio
+
+        try:
+            asyncio.run(self.serve())
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.executor.shutdown(wait=False)
+            logger.info('Server stopped')
+
 
-            os.system('systemctl daemon-reload >/dev/null')
+class UnixSocketServer(threading.Thread):
+    PATH = '/run/checker.sock'
+    MODE = 0o660
+    MAX_FRAME_SIZE = 1024 * 1024
 
-    def enable_auto_start(self) -> bool:
-        if not self.is_enabled:
-            os.system('systemctl enable %s >/dev/null' % self.CONFIG_SYSTEMD)
+    # Every frame is a 4 byte big-endian length followed by a JSON document
+    HEADER_SIZE = 4
 
-        return self.is_enabled
+    def __init__(self, path: str = None, group: str = None, mode: int = None):
+        super(UnixSocketServer, self).__init__()
+        self.daemon = True
 
-    def disable_auto_start(self) -> bool:
-        if self.is_enabled:
-            os.system('systemctl disable %s >/dev/null' % self.CONFIG_SYSTEMD)
+        self.path = path or self.PATH
+        self.group = group
+        self.mode = mode if mode is not None else self.MODE
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
-        return not self.is_enabled
+    @classmethod
+    def send_frame(cls, sock: socket.socket, payload: bytes) -> None:
+        sock.sendall(len(payload).to_bytes(cls.HEADER_SIZE, 'big') + payload)
 
-    def create_service(self) -> bool:
-        self.create_systemd_config()
-        return self.is_created
+    @classmethod
+    def recv_exactly(cls, sock: socket.socket, size: int) -> t.Optional[bytes]:
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
 
+        return bytes(data)
 
-class CheckerManager:
-    RAW_URL_DATA = 'https://raw.githubusercontent.com/NT-GIT-HUB/DataPlugin/main/user_check.py'
+    @classmethod
+    def recv_frame(cls, sock: socket.socket) -> t.Optional[bytes]:
+        header = cls.recv_exactly(sock, cls.HEADER_SIZE)
+        if header is None:
+            return None
 
-    EXECUTABLE_PATH = '/usr/bin/'
-    EXECUTABLE_NAME = 'checker'
-    EXECUTABLE_FILE = EXECUTABLE_PATH + EXECUTABLE_NAME
+        length = int.from_bytes(header, 'big')
+        if length > cls.MAX_FRAME_SIZE:
+            raise RequestError(413, 'Frame too large')
+
+        return cls.recv_exactly(sock, length)
 
     @staticmethod
-    def create_executable() -> None:
-        of_path = os.path.join(os.path.expanduser('~'), 'chk.py')
-        to_path = CheckerManager.EXECUTABLE_FILE
+    def execute(payload: bytes) -> t.Tuple[t.Optional[str], bytes]:
+        try:
+            request = json.loads(payload)
+            if not isinstance(request, dict):
+                raise ValueError('Request must be an object')
 
-        if os.path.exists(to_path):
-            os.unlink(to_path)
+            users = request.get('users')
+            if users is not None and not isinstance(users, list):
+                raise ValueError('users must be a list')
 
-        logger.info('Creating executable file...')
-        logger.info('From: %s' % of_path)
-        logger.info('To: %s' % to_path)
+            username = request.get('username')
+            command = str(request.get('command', 'CHECK')).upper()
+
+            if command in ('CHECK', 'KILL') and not username and (
+                command == 'KILL' or users is None
+            ):
+                raise ValueError('Missing username')
+
+            function_executor = FunctionExecutor(
+                command,
+                str(username) if username is not None else None,
+                [str(user) for user in users] if users is not None else None,
+                request.get('select', 'all'),
+            )
+            result = function_executor.execute()
+
+        except ValueError as e:
+            return None, json.dumps({'error': str(e)}).encode('utf-8')
 
+        if isinstance(result, (dict, str)):
+            return command, json.dumps(result).encode('utf-8')
+
+        encoder = ResponseEncoder.get_instance()
+        return command, b''.join(encoder.iter_encode(result, encoder.JSON, len(users)))
+
+    def handle(self, client: socket.socket) -> None:
         try:
-            os.chmod(of_path, 0o755)
-            os.symlink(of_path, to_path)
-            logger.info('Done!')
+            while True:
+                payload = self.recv_frame(client)
+                if payload is None:
+                    break
+
+                start = time.perf_counter()
+                command, response = self.execute(payload)
+                self.send_frame(client, response)
+
+                Metrics.get_instance().observe_request(command, time.perf_counter() - start)
+
+        except RequestError as e:
+            self.send_frame(client, json.dumps({'error': str(e)}).encode('utf-8'))
+
+        except ConnectionError:
+            pass
+
         except Exception as e:
             logger.error(e)
 
-    @staticmethod
-    def get_data() -> str:
-        import requests
+        finally:
+            client.close()
 
-        response = requests.get(CheckerManager.RAW_URL_DATA)
-        return response.text
+    def remove_stale(self) -> None:
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            return
 
-    @staticmethod
-    def check_update() -> t.Union[bool, str]:
-        data = CheckerManager.get_data()
+        if not stat.S_ISSOCK(mode):
+            raise OSError('%s exists and is not a socket' % self.path)
 
-        if data:
-            version = data.split('__version__ = ')[1].split('\n')[0].strip('\'')
-            return version != __version__, version
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            probe.settimeout(1.0)
+            try:
+                probe.connect(self.path)
+            except ConnectionRefusedError:
+                # Nobody is listening, the socket was left behind by an instance that died
+                os.unlink(self.path)
+                return
+            except socket.timeout:
+                pass
 
-        return False, __version__
+        raise OSError('%s is already served by another instance' % self.path)
 
-    @staticmethod
-    def update() -> bool:
-        success, version = CheckerManager.check_update()
-        if not success:
-            logger.info('No update available')
-            return False
+    def bind(self) -> None:
+        self.remove_stale()
+        self.socket.bind(self.path)
 
-        logger.info('New version available: %s' % version)
+        try:
+            if self.group is not None:
+                os.chown(self.path, -1, grp.getgrnam(self.group).gr_gid)
 
-        data = CheckerManager.get_data()
-        if not data:
-            return False
+            os.chmod(self.path, self.mode)
+        except (OSError, KeyError) as e:
+            self.socket.close()
+            os.unlink(self.path)
+            raise OSError('Failed to set owner of %s: %s' % (self.path, e))
 
-        with open(__file__, 'w') as f:
-            f.write(data)
+        self.socket.listen(128)
 
-        CheckerManager.create_executable()
-        ServiceManager().restart()
-        return True
+    def start(self) -> None:
+        # Bind before the thread starts so the caller sees a path that is in use
+        self.bind()
+        super(UnixSocketServer, self).start()
 
-    @staticmethod
-    def remove_executable() -> None:
-        os.remove(CheckerManager.EXECUTABLE_FILE)
+    def run(self) -> None:
+        logger.info('Unix socket server started on %s' % self.path)
 
+        while True:
+            client, _ = self.socket.accept()
+            threading.Thread(target=self.handle, args=(client,), daemon=True).start()
 
-def check_user(username: str) -> t.Dict[str, t.Any]:
-    try:
-        checker = CheckerUserManager(username)
 
-        count = checker.get_connections()
-        expiration_date = checker.get_expiration_date()
-        expiration_days = checker.get_expiration_days(expiration_date)
-        limit_connection = checker.get_limiter_connection()
-        time_online = checker.get_time_online()
+class ProcessSupervisor:
+    RESTART_DELAY = 1.0
+    CONTROL_PATH = os.path.join(SharedStateIndex.DIRECTORY, 'control.sock')
+    CONTROL_TIMEOUT = 5.0
 
-        return {
-            'username': username,
-            'count_connection': count,
-            'limit_connection': limit_connection,
-            'expiration_date': expiration_date,
-            'expiration_days': expiration_days,
-            'time_online': time_online,
-            'version': __version__,
-        }
-    except Exception as e:
-        return {'error': str(e)}
+    # Set inside worker processes, where kills are forwarded to the supervisor
+    control_path = None
 
+    def __init__(self, processes: int, options: t.Dict[str, t.Any]):
+        self.processes = processes
+        self.options = options
 
-def kill_user(username: str) -> dict:
-    result = {
-        'success': True,
-        'error': None,
-    }
+        import multiprocessing
 
-    try:
-        checker = CheckerUserManager(username)
-        checker.kill_connection()
-        return result
-    except Exception as e:
-        result['success'] = False
-        result['error'] = str(e)
+        # Spawned workers start from a clean interpreter instead of inheriting the parent's threads
+        self.context = multiprocessing.get_context('spawn')
+        self.children = [None] * processes
+        self.restarts = 0
 
+    @staticmethod
+    def serve(options: t.Dict[str, t.Any]) -> None:
+        OpenVPNManager.MODE = OpenVPNManager.SHARED
+        ProcessSupervisor.control_path = options['control_path']
+
+        cache = ResultCache.get_instance()
+        cache.ttl = options['cache_ttl']
+        cache.max_size = options['cache_size']
+        cache.register_metrics(Metrics.get_instance())
+
+        SharedStateReader.start_instance(options['state_interval'], options['state_path'])
+
+        server_class = AsyncServer if options['engine'] == 'asyncio' else Server
+        server = server_class(
+            '0.0.0.0',
+            options['port'],
+            options['workers'],
+            options['backlog'],
+            reuse_port=True,
+        )
+        server.run()
 
-class ParserServerRequest:
-    def __init__(self, data: bytes):
-        self.data = data
-        self.command = None
-        self.content = None
+    def spawn(self, index: int) -> None:
+        process = self.context.Process(
+            target=self.serve,
+            args=(self.options,),
+            name='checker-worker-%d' % index,
+            daemon=True,
+        )
+        process.start()
 
-        self.commands_allowed = ['CHECK' 'KILL']
+        self.children[index] = process
+        logger.info('Worker process %d started: pid %d' % (index, process.pid))
 
-    def parse(self) -> None:
+    def stop(self, *args) -> None:
+        raise KeyboardInterrupt()
+
+    def run(self) -> None:
         try:
-            data = self.data.decode('utf-8')
+            for path in (self.options['state_path'], self.options['control_path']):
+                SharedStateIndex.prepare_directory(os.path.dirname(path))
+
+            UnixSocketServer(self.options['control_path']).start()
+        except OSError as e:
+            logger.error('Worker processes not started: %s' % e)
+            return
 
-            first_line = data.split('\n')[0]
-            path = first_line.split(' ')[1]
+        StateCollector.start_instance(self.options['state_interval'], self.options['state_path'])
+        signal.signal(signal.SIGTERM, self.stop)
 
-            self.command = path.split('/')[1]
-            self.content = path.split('/')[2].split('?')[0]
+        for index in range(self.processes):
+            self.spawn(index)
 
-        except Exception:
-            self.command = None
-            self.content = None
+        try:
+            while True:
+                time.sleep(self.RESTART_DELAY)
 
+                for index, process in enumerate(self.children):
+                    if not process.is_alive():
+                        logger.error(
+                            'Worker process %d exited with code %s, restarting'
+                            % (index, process.exitcode)
+                        )
+                        self.restarts += 1
+                        self.spawn(index)
 
-class FunctionExecutor:
-    def __init__(self, command: str, content: str):
-        self.command = command
-        self.content = content
+        except KeyboardInterrupt:
+            pass
 
-    def execute(self) -> t.Dict[str, t.Any]:
-        if self.command.upper() == 'CHECK':
-            return check_user(self.content)
+        finally:
+            for process in self.children:
+                process.terminate()
 
-        if self.command.upper() == 'KILL':
-            return kill_user(self.content)
+            for process in self.children:
+                process.join(timeout=5)
 
-        return {'error': 'Command not allowed'}
+            for path in (self.options['state_path'], self.options['control_path']):
+                if os.path.exists(path):
+                    os.remove(path)
 
+            logger.info('Worker processes stopped')
 
-class WorkerThread(threading.Thread):
-    def __init__(self, queue: queue.Queue):
-        super(WorkerThread, self).__init__()
-        self.queue = queue
+
+class FakeManagementServer(threading.Thread):
+    def __init__(self, clients: t.List[t.Tuple[str, int, int]]):
+        super(FakeManagementServer, self).__init__()
         self.daemon = True
 
-        self.is_running = False
+        self.status = self.build_status(clients)
 
-    def parse_request(self, data: bytes) -> t.Dict[str, t.Any]:
-        request = ParserServerRequest(data.strip())
-        request.parse()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('localhost', 0))
+        self.socket.listen(1)
 
-        function_executor = FunctionExecutor(request.command, request.content)
-        return function_executor.execute()
+        self.port = self.socket.getsockname()[1]
+
+    @staticmethod
+    def build_status(clients: t.List[t.Tuple[str, int, int]]) -> bytes:
+        lines = [
+            'TITLE,OpenVPN 2.5 (fake)',
+            'TIME,now,%d' % time.time(),
+            'HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,Virtual IPv6 Address,'
+            'Bytes Received,Bytes Sent,Connected Since,Connected Since (time_t),Username,'
+            'Client ID,Peer ID',
+        ]
+        lines.extend(
+            'CLIENT_LIST,%s,127.0.0.1:%d,10.8.0.1,,0,0,now,%d,UNDEF,%d,%d'
+            % (name, 10000 + client_id, connected_since, client_id, client_id)
+            for name, client_id, connected_since in clients
+        )
+        lines.append('GLOBAL_STATS,Max bcast/mcast queue length,0')
+        lines.append('END')
+        return ('\r\n'.join(lines) + '\r\n').encode()
+
+    def handle(self, client: socket.socket) -> None:
+        client.sendall(b'>INFO:OpenVPN Management Interface (fake)\r\n')
+
+        with client, client.makefile('rb') as f:
+            for line in f:
+                if line.startswith(b'status'):
+                    client.sendall(self.status)
+                else:
+                    client.sendall(b'SUCCESS: done\r\n')
+
+    def run(self) -> None:
+        # Like OpenVPN, one management client at a time, the next one waits in the backlog
+        while True:
+            client, _ = self.socket.accept()
 
-    def run(self):
-        self.is_running = True
-        while self.is_running:
             try:
-                client, addr = self.queue.get()
-                logger.info('Client connected: %s' % addr)
+                self.handle(client)
+            except OSError:
+                pass
 
-                data = client.recv(8192 * 8)
-                if not data:
-                    continue
 
-                response_data = 'HTTP/1.1 200 OK\r\n Content-Type: application/json\r\n\r\n'
-                response_data += json.dumps(self.parse_request(data))
+class FakeEnvironment:
+    # Above the kernel's pid_max, so a KILL during a benchmark can never hit a real process
+    PID_BASE = 5000000
+    UID_BASE = 60000
 
-                client.send(response_data.encode('utf-8'))
-                client.close()
+    def __init__(self, users: int = 1000, sessions: int = 2):
+        import tempfile
 
-                logger.info('Client disconnected: %s' % addr)
-            except Exception as e:
-                logger.error(e)
+        self.users = ['bench%05d' % index for index in range(users)]
+        self.sessions = sessions
 
-    def stop(self):
-        self.is_running = False
+        self.path = tempfile.mkdtemp(prefix='checker-bench-')
+        self.proc_path = os.path.join(self.path, 'proc')
+        self.management = None
 
+    def write(self, name: str, lines: t.Iterable[str]) -> str:
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
 
-class ThreadPool:
-    def __init__(self, max_workers: int = 10):
-        self.queue = queue.Queue()
-        self.workers = []
-        self.max_workers = max_workers
+        with open(path, 'w') as f:
+            f.writelines(line + '\n' for line in lines)
 
-    def start(self):
-        for _ in range(self.max_workers):
-            worker = WorkerThread(self.queue)
-            worker.start()
-            self.workers.append(worker)
+        return path
 
-    def join(self):
-        for worker in self.workers:
-            worker.stop()
-            worker.join()
+    def create_proc(self) -> None:
+        clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.write('proc/stat', ['cpu 0 0 0 0', 'btime %d' % (time.time() - 86400)])
+
+        pid = self.PID_BASE
+        for index in range(len(self.users)):
+            uid = self.UID_BASE + index
+
+            for session in range(self.sessions):
+                start_ticks = (86400 - 60 * (self.sessions - session)) * clock_ticks
+                stat = '%d (sshd) S 1 %d %d 0 -1 0 0 0 0 0 0 0 0 0 20 0 1 0 %d 0 0' % (
+                    pid,
+                    pid,
+                    pid,
+                    start_ticks,
+                )
+
+                status = ['Name:\tsshd', 'Uid:\t%d\t%d\t%d\t%d' % ((uid,) * 4)]
+
+                self.write('proc/%d/stat' % pid, [stat])
+                self.write('proc/%d/status' % pid, status)
+                pid += 1
+
+    def create(self) -> 'FakeEnvironment':
+        self.create_proc()
+
+        passwd, shadow, limits = [], [], []
+        for index, name in enumerate(self.users):
+            uid = self.UID_BASE + index
+            passwd.append('%s:x:%d:%d::/home/%s:/bin/false' % (name, uid, uid, name))
+            shadow.append('%s:*:19000:0:99999:7::%d:' % (name, 20000 + index % 365))
+            limits.append('%s %d' % (name, self.sessions))
+
+        self.write('passwd', passwd)
+        self.write('shadow', shadow)
+        self.write('usuarios.db', limits)
+        os.makedirs(os.path.join(self.path, 'openvpn'), exist_ok=True)
+
+        now = int(time.time())
+        clients = [(name, index, now - 30) for index, name in enumerate(self.users[::2])]
+
+        self.management = FakeManagementServer(clients)
+        self.management.start()
+
+        return self
+
+    def install(self) -> None:
+        ProcScanner.PROC_PATH = self.proc_path
+        PasswdIndex.PATH = os.path.join(self.path, 'passwd')
+        ShadowIndex.PATH = os.path.join(self.path, 'shadow')
+        LimitIndex.PATH = os.path.join(self.path, 'usuarios.db')
+
+        OpenVPNManager.MANAGEMENT_PORT = self.management.port
+        OpenVPNManager.CONFIG_PATH = os.path.join(self.path, 'openvpn')
+        OpenVPNManager.LOG_PATH = os.path.join(self.path, 'openvpn')
+
+    def remove(self) -> None:
+        import shutil
+
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Benchmark:
+    ENGINES = {'threads': Server, 'asyncio': AsyncServer}
+    MODES = ('none', 'cache', 'collector')
+
+    def __init__(
+        self,
+        environment: FakeEnvironment,
+        concurrency: int = 20,
+        duration: float = 5.0,
+        rate: float = 0.0,
+        kill_ratio: float = 0.01,
+        workers: int = 10,
+    ):
+        self.environment = environment
+        self.concurrency = concurrency
+        self.duration = duration
+        self.rate = rate
+        self.kill_ratio = kill_ratio
+        self.workers = workers
 
-    def add_task(self, task: socket.socket, *args):
-        self.queue.put((task, args))
+    @staticmethod
+    def get_free_port() -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
 
+    def serve(self, engine: str, mode: str, port: int) -> None:
+        logging.getLogger().setLevel(logging.WARNING)
+        self.environment.install()
+        OpenVPNManager.MODE = OpenVPNManager.PERSISTENT
 
-class Server:
-    def __init__(self, host: str, port: int, num_workers: int = 10):
-        self.host = host
-        self.port = port
+        cache = ResultCache.get_instance()
+        cache.ttl = 1.0 if mode == 'cache' else 0
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if mode == 'collector':
+            StateCollector.start_instance(1.0)
 
-        self.pool = ThreadPool(num_workers)
-        self.pool.start()
+        self.ENGINES[engine]('127.0.0.1', port, self.workers).run()
 
-    def handle(self, client, addr) -> None:
-        self.pool.add_task(client, addr)
+    @staticmethod
+    def wait_ready(port: int, timeout: float = 10.0) -> None:
+        deadline = time.monotonic() + timeout
 
-    def run(self) -> None:
-        self.socket.bind((self.host, self.port))
-        self.socket.listen(5)
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
 
-        logger.info('Server started on %s:%s' % (self.host, self.port))
+        raise TimeoutError('Benchmark server did not start on port %d' % port)
+
+    @staticmethod
+    def read_response(sock: socket.socket, buffer: bytes) -> bytes:
+        while b'\r\n\r\n' not in buffer:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError('Server closed the connection')
+            buffer += data
+
+        head, _, buffer = buffer.partition(b'\r\n\r\n')
+        length = 0
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                length = int(value)
+
+        while len(buffer) < length:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError('Server closed the connection')
+            buffer += data
+
+        return buffer[length:]
+
+    def drive(self, port: int, latencies: t.List[float], errors: t.List[int], seed: int) -> None:
+        import random
+
+        generator = random.Random(seed)
+        users = self.environment.users
+        interval = self.concurrency / self.rate if self.rate > 0 else 0
+        deadline = time.monotonic() + self.duration
+
+        sock = socket.create_connection(('127.0.0.1', port))
+        buffer = b''
+        next_at = time.monotonic()
+
+        while time.monotonic() < deadline:
+            if interval:
+                next_at += interval
+                time.sleep(max(next_at - time.monotonic(), 0))
+
+            username = generator.choice(users)
+            if generator.random() < self.kill_ratio:
+                path = '/kill/%s?select=newest:1' % username
+            else:
+                path = '/check/%s' % username
+
+            start = time.perf_counter()
+            try:
+                sock.sendall(('GET %s HTTP/1.1\r\nHost: bench\r\n\r\n' % path).encode())
+                buffer = self.read_response(sock, buffer)
+                latencies.append(time.perf_counter() - start)
+            except OSError:
+                errors.append(1)
+                sock.close()
+                sock = socket.create_connection(('127.0.0.1', port))
+                buffer = b''
+
+        sock.close()
+
+    @staticmethod
+    def percentile(values: t.List[float], percent: float) -> float:
+        if not values:
+            return 0.0
+
+        return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+    def run_case(self, engine: str, mode: str) -> t.Dict[str, t.Any]:
+        import multiprocessing
+
+        # The server inherits the fake environment, which a spawned or forkserver child would not
+        context = multiprocessing.get_context('fork')
+
+        port = self.get_free_port()
+        process = context.Process(target=self.serve, args=(engine, mode, port), daemon=True)
+        process.start()
 
         try:
-            while True:
-                client, addr = self.socket.accept()
-                self.handle(client, addr)
+            self.wait_ready(port)
 
-        except KeyboardInterrupt:
-            pass
+            latencies, errors = [], []
+            threads = [
+                threading.Thread(target=self.drive, args=(port, latencies, errors, seed))
+                for seed in range(self.concurrency)
+            ]
 
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
         finally:
-            self.socket.close()
-            logger.info('Server stopped')
+            process.terminate()
+            process.join()
+
+        latencies.sort()
+        return {
+            'engine': engine,
+            'mode': mode,
+            'requests': len(latencies),
+            'errors': len(errors),
+            'throughput': len(latencies) / elapsed,
+            'p50': self.percentile(latencies, 50),
+            'p95': self.percentile(latencies, 95),
+            'p99': self.percentile(latencies, 99),
+        }
+
+    def run(self, engines: t.List[str], modes: t.List[str]) -> t.List[t.Dict[str, t.Any]]:
+        print(
+            '%-8s %-10s %9s %7s %10s %9s %9s %9s'
+            % ('engine', 'mode', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+        )
+
+        results = []
+        for engine in engines:
+            for mode in modes:
+                result = self.run_case(engine, mode)
+                results.append(result)
+
+                print(
+                    '%-8s %-10s %9d %7d %10.1f %9.3f %9.3f %9.3f'
+                    % (
+                        result['engine'],
+                        result['mode'],
+                        result['requests'],
+                        result['errors'],
+                        result['throughput'],
+                        result['p50'] * 1000,
+                        result['p95'] * 1000,
+                        result['p99'] * 1000,
+                    )
+                )
+
+        return results
 
 
 def main():
@@ -588,9 +3668,59 @@ def main():
     parser.add_argument('-u', '--username', type=str)
     parser.add_argument('-p', '--port', type=int, help='Port to run server')
     parser.add_argument('--json', action='store_true', help='Output in json format')
+    parser.add_argument(
+        '--local',
+        action='store_true',
+        help='Check -u locally instead of asking the running server first',
+    )
+    parser.add_argument(
+        '--unix-socket',
+        type=str,
+        nargs='?',
+        const=UnixSocketServer.PATH,
+        help='Also serve length-prefixed JSON on this Unix socket (default %s)'
+        % UnixSocketServer.PATH,
+    )
+    parser.add_argument(
+        '--unix-socket-group',
+        type=str,
+        help='Group that owns the Unix socket, so its members can connect',
+    )
+    parser.add_argument(
+        '--unix-socket-mode',
+        type=lambda value: int(value, 8),
+        help='Permissions of the Unix socket in octal (default %o)' % UnixSocketServer.MODE,
+    )
 
     parser.add_argument('--run', action='store_true', help='Run server')
     parser.add_argument('--workers', type=int, default=10, help='Number of workers')
+    parser.add_argument(
+        '--engine',
+        type=str,
+        default='threads',
+        choices=['threads', 'asyncio'],
+        help='Server engine',
+    )
+    parser.add_argument('--backlog', type=int, default=128, help='Listen backlog')
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='Worker processes sharing the port with SO_REUSEPORT',
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        type=float,
+        default=1.0,
+        help='Seconds to cache check results, 0 to disable',
+    )
+    parser.add_argument('--cache-size', type=int, default=10000, help='Max cached users')
+    parser.add_argument(
+        '--collect-interval',
+        type=float,
+        default=0,
+        help='Precompute all user states every N seconds, 0 to disable',
+    )
 
     parser.add_argument('--create-service', action='store_true', help='Create service')
     parser.add_argument('--remove-service', action='store_true', help='Remove service')
@@ -601,6 +3731,34 @@ def main():
     parser.add_argument('--restart', action='store_true', help='Restart server')
 
     parser.add_argument('--kill', action='store_true', help='Kill user')
+    parser.add_argument(
+        '--ssh-tracker',
+        action='store_true',
+        help='Count SSH sessions from auth log events instead of polling processes',
+    )
+    parser.add_argument(
+        '--auth-log',
+        type=str,
+        default=AuthLogTracker.LOG_PATH,
+        help='Auth log or journal export file read by --ssh-tracker',
+    )
+    parser.add_argument(
+        '--select',
+        type=str,
+        default='all',
+        help='Sessions to kill: all, oldest:N, newest:N, ssh:<pid> or openvpn:<client id>',
+    )
+    parser.add_argument(
+        '--enforce',
+        action='store_true',
+        help='Kill the newest sessions of users over their connection limit',
+    )
+    parser.add_argument(
+        '--enforce-interval',
+        type=float,
+        default=5.0,
+        help='Seconds between enforcer ticks',
+    )
 
     parser.add_argument('--update', action='store_true', help='Update server')
     parser.add_argument('--check-update', action='store_true', help='Check update')
@@ -617,9 +3775,58 @@ def main():
     parser.add_argument('--start-screen', action='store_true', help='Start server on screen')
     parser.add_argument('--stop-screen', action='store_true', help='Stop server on screen')
 
+    parser.add_argument('--bench', action='store_true', help='Benchmark against a fake environment')
+    parser.add_argument(
+        '--bench-engines',
+        type=str,
+        default='threads,asyncio',
+        help='Comma separated engines to benchmark',
+    )
+    parser.add_argument(
+        '--bench-modes',
+        type=str,
+        default=','.join(Benchmark.MODES),
+        help='Comma separated caching modes to benchmark: none, cache, collector',
+    )
+    parser.add_argument('--bench-users', type=int, default=1000, help='Fake users')
+    parser.add_argument('--bench-sessions', type=int, default=2, help='Fake sessions per user')
+    parser.add_argument('--bench-concurrency', type=int, default=20, help='Concurrent clients')
+    parser.add_argument('--bench-duration', type=float, default=5.0, help='Seconds per case')
+    parser.add_argument(
+        '--bench-rate',
+        type=float,
+        default=0,
+        help='Total requests per second, 0 for as fast as possible',
+    )
+    parser.add_argument(
+        '--bench-kill-ratio',
+        type=float,
+        default=0.01,
+        help='Share of requests that are KILL instead of CHECK',
+    )
+
     parser.add_argument('--version', action='version', version='%(prog)s v' + str(__version__))
 
     args = parser.parse_args()
+
+    if args.bench:
+        environment = FakeEnvironment(args.bench_users, args.bench_sessions).create()
+
+        try:
+            benchmark = Benchmark(
+                environment,
+                concurrency=args.bench_concurrency,
+                duration=args.bench_duration,
+                rate=args.bench_rate,
+                kill_ratio=args.bench_kill_ratio,
+                workers=args.workers,
+            )
+            benchmark.run(args.bench_engines.split(','), args.bench_modes.split(','))
+        finally:
+            environment.remove()
+
+        return
+
     config = CheckerUserConfig()
     service = ServiceManager()
 
@@ -678,17 +3885,42 @@ def main():
             logger.info('Disable service success')
 
     if args.username:
+        results = {}
+
+        if not args.local:
+            try:
+                for command in (['KILL'] if args.kill else []) + ['CHECK']:
+                    if args.unix_socket:
+                        results[command] = query_unix_socket(
+                            args.unix_socket, command, args.username, args.select
+                        )
+                    else:
+                        results[command] = query_daemon(
+                            config.port, command, args.username, args.select
+                        )
+            except (OSError, ValueError) as e:
+                logger.debug('Daemon not available: %s' % e)
+
         if args.kill:
-            if kill_user(args.username):
+            # With the daemon down nobody holds the management port, so the kill can use it
+            result = results.get('KILL') or kill_user(args.username, args.select)
+
+            if result.get('success'):
                 logger.info('Kill user success')
             else:
                 logger.error('Kill user failed')
 
+        if 'CHECK' not in results:
+            # Counting from the status log never waits on a management slot the daemon may hold
+            OpenVPNManager.MODE = OpenVPNManager.LOG
+
+        result = results.get('CHECK') or check_user(args.username)
+
         if args.json:
-            logger.info(json.dumps(check_user(args.username), indent=4))
+            logger.info(json.dumps(result, indent=4))
             return
 
-        logger.info(check_user(args.username))
+        logger.info(result)
 
     if args.port:
         config.port = args.port
@@ -705,11 +3937,75 @@ def main():
         CheckerManager.remove_executable()
         CheckerUserConfig.remove_config()
 
+    if args.run or args.enforce:
+        # The daemon keeps the one management connection OpenVPN serves for its whole life
+        OpenVPNManager.MODE = OpenVPNManager.PERSISTENT
+
+    if args.ssh_tracker and (args.run or args.enforce):
+        logger.info('SSH tracker: %s' % args.auth_log)
+        AuthLogTracker.start_instance(args.auth_log)
+
+    if args.enforce:
+        logger.info('Enforcer: every %ss' % args.enforce_interval)
+        enforcer = LimitEnforcer.start_instance(args.enforce_interval)
+
+        if not args.run:
+            try:
+                enforcer.join()
+            except KeyboardInterrupt:
+                pass
+            return
+
     if args.run:
         workers = args.workers
         logger.info('Workers: %s' % workers)
+        logger.info('Engine: %s' % args.engine)
+        logger.info('Cache: ttl=%ss size=%s' % (args.cache_ttl, args.cache_size))
+
+        # Also used by the supervisor, which answers CHECKs on the Unix and control sockets
+        cache = ResultCache.get_instance()
+        cache.ttl = args.cache_ttl
+        cache.max_size = args.cache_size
+        cache.register_metrics(Metrics.get_instance())
+
+        if args.unix_socket:
+            try:
+                UnixSocketServer(
+                    args.unix_socket, args.unix_socket_group, args.unix_socket_mode
+                ).start()
+            except OSError as e:
+                logger.error('Unix socket server not started: %s' % e)
+                return
+
+        if args.processes > 1:
+            interval = args.collect_interval or 1.0
+            logger.info('Processes: %d, collector every %ss' % (args.processes, interval))
+
+            supervisor = ProcessSupervisor(
+                args.processes,
+                {
+                    'engine': args.engine,
+                    'port': config.port,
+                    'workers': workers,
+                    'backlog': args.backlog,
+                    'cache_ttl': args.cache_ttl,
+                    'cache_size': args.cache_size,
+                    'state_interval': interval,
+                    'state_path': SharedStateIndex.PATH,
+                    'control_path': ProcessSupervisor.CONTROL_PATH,
+                },
+            )
+            supervisor.run()
+            return
+
+        if args.collect_interval > 0:
+            logger.info('Collector: every %ss' % args.collect_interval)
+            StateCollector.start_instance(args.collect_interval)
+
         logger.info('Run Socket server')
-        server = Server('0.0.0.0', config.port, workers)
+
+        server_class = AsyncServer if args.engine == 'asyncio' else Server
+        server = server_class('0.0.0.0', config.port, workers, args.backlog)
         server.run()
 
     if args.start: